@@ -0,0 +1,630 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+:Name:
+    benchmark.py
+
+:Authors:
+    Soufian Salim (soufi@nsal.im)
+"""
+
+import doctest
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import xml.etree.cElementTree as ET
+import xmltodict
+
+from multiprocessing import Pool
+from optparse import OptionParser
+from conversations import Conversation, Message, Participant
+from normalizer import XML_DECLARATION, extract_data, conversation_xml
+from segmentation import load_tokenizer, segment_batch, segment_messages, clear_memos
+from shards import read_source
+from synthetic import write_dataset
+from utility import timed_print, save_to_file, list_xml_files, disable_progress, peak_memory
+
+
+CONVERSATION_FIELDS = ["id", "subject", "category", "views", "status"]
+
+MESSAGE_FIELDS = ["id", "conversation_id", "medium", "private", "likes", "views", "importance", "subject",
+    "daytime", "encoding", "MIME", "body", "form", "kbitems", "analysis"]
+
+PARTICIPANT_FIELDS = ["id", "role", "real_name", "user_name", "email", "description"]
+
+PIPELINE_STAGES = ["extract_data", "xml_serialize", "xml_unserialize", "segmentation", "xml_to_tsv", "xml_to_txt",
+    "xml_to_html"]
+
+STARTUP_COMMANDS = [
+    ["normalizer.py", "{folder}", "startup"],
+    ["xml_to_tsv.py", "{folder}"],
+    ["xml_to_txt.py", "{folder}"],
+    ["xml_to_html.py", "{folder}"],
+    ["xml_export.py", "{folder}"],
+]
+
+
+def benchmark(opts, args):
+    """
+    Runs the requested benchmarks
+    """
+    names = args or sorted(BENCHMARKS)
+
+    for name in names:
+        timed_print("Running the {0} benchmark".format(name))
+
+        BENCHMARKS[name](opts)
+
+
+def bench_memory(opts):
+    """
+    Compares the bytes per loaded message of the slotted classes with the former dict-based ones
+    """
+    xml = make_xml(make_conversation(opts.messages))
+
+    conversation = Conversation(xml)
+
+    after = deep_sizeof(conversation.messages) / float(opts.messages)
+
+    legacy = [legacy_message(message) for message in conversation.messages]
+
+    before = deep_sizeof(legacy) / float(opts.messages)
+
+    timed_print("dict-based: {0:.0f} bytes/message".format(before))
+    timed_print("slotted: {0:.0f} bytes/message".format(after))
+
+    timed_print("Saved: {0:.0%}".format(1 - after / before))
+
+
+def bench_unserialize(opts):
+    """
+    Compares the iterparse loader with the former xmltodict loader on a large conversation
+    """
+    xml = make_xml(make_conversation(opts.messages))
+
+    timed_print("Loading a conversation of {0} messages ({1} bytes)".format(opts.messages, len(xml)))
+
+    if snapshot(Conversation(xml)) != snapshot(xmltodict_unserialize(xml)):
+        raise AssertionError("the iterparse and xmltodict loaders disagree")
+
+    before = best_time(lambda: xmltodict_unserialize(xml), opts.repeat)
+    after = best_time(lambda: Conversation(xml), opts.repeat)
+
+    report("xmltodict", before, opts.messages)
+    report("iterparse", after, opts.messages)
+
+    timed_print("Speedup: {0:.2f}x".format(before / after))
+
+
+def bench_serialize(opts):
+    """
+    Compares the streaming XML writer with the serialization of an element tree by ET.tostring
+    """
+    conversation = make_conversation(opts.messages)
+
+    legacy = lambda: XML_DECLARATION + ET.tostring(conversation.xml_serialize())
+
+    if legacy() != conversation_xml(conversation):
+        raise AssertionError("the streaming writer and ET.tostring disagree")
+
+    before = best_time(legacy, opts.repeat)
+    after = best_time(lambda: conversation_xml(conversation), opts.repeat)
+
+    report("ET.tostring", before, opts.messages)
+    report("xml_write", after, opts.messages)
+
+    timed_print("Speedup: {0:.2f}x".format(before / after))
+
+
+def bench_segmentation(opts):
+    """
+    Compares the batch segmentation engine with the former per-message segmentation, on bodies
+    sharing some lines and on bodies whose lines are all distinct
+
+    The memos of the engine are emptied before each timed run.
+    """
+    load_tokenizer()
+
+    for distinct in (False, True):
+        bodies = [make_body(i, 8, distinct) for i in range(opts.messages)]
+
+        if segment_batch(bodies) != [legacy_segment(body) for body in bodies]:
+            raise AssertionError("the batch and per-message segmentations disagree")
+
+        before = best_time(lambda: [legacy_segment(body) for body in bodies], opts.repeat)
+        after = best_time(lambda: (clear_memos(), segment_batch(bodies)), opts.repeat) # nothing memoised by former runs
+
+        lines = "distinct lines" if distinct else "shared lines"
+
+        report("per-message ({0})".format(lines), before, opts.messages)
+        report("batch ({0})".format(lines), after, opts.messages)
+
+        timed_print("Speedup ({0}): {1:.2f}x".format(lines, before / after))
+
+
+def bench_startup(opts):
+    """
+    Times each command line script on an empty folder in a fresh interpreter, failing when one
+    takes longer than opts.max_startup seconds
+    """
+    source_folder = os.path.dirname(os.path.abspath(__file__))
+    empty_folder = tempfile.mkdtemp()
+
+    slow = []
+
+    try:
+        with open(os.devnull, "w") as devnull:
+            for command in STARTUP_COMMANDS:
+                command = [sys.executable, os.path.join(source_folder, command[0])] + \
+                    [argument.format(folder=empty_folder) for argument in command[1:]]
+
+                seconds = best_time(lambda: subprocess.check_call(command, stdout=devnull, stderr=devnull), opts.repeat)
+
+                timed_print("{0}: {1:.3f}s".format(os.path.basename(command[1]), seconds))
+
+                if opts.max_startup and seconds > opts.max_startup:
+                    slow.append(os.path.basename(command[1]))
+    finally:
+        shutil.rmtree(empty_folder)
+
+    if slow:
+        raise AssertionError("startup took more than {0}s for {1}".format(opts.max_startup, ", ".join(slow)))
+
+
+def bench_pipeline(opts):
+    """
+    Times each stage of the pipeline on a synthetic dataset, and writes the messages per second
+    and the peak memory of each stage to opts.results
+
+    Each stage runs in a fresh process, so that its peak memory is its own (setup included).
+    """
+    folder = tempfile.mkdtemp()
+
+    settings = {"email_files": 2, "threads": 50 * opts.scale, "depth": 3, "fanout": 2, "forum_files": 1,
+        "forums": 2, "forum_threads": 50 * opts.scale, "posts": 20, "seed": 0}
+
+    results = {"python": sys.version.split()[0], "dataset": dict(settings), "repeat": opts.repeat, "stages": {}}
+
+    try:
+        results["dataset"]["messages"] = write_dataset(folder, **settings)
+
+        run_in_process(prepare_pipeline, folder)
+
+        for stage in PIPELINE_STAGES:
+            seconds, messages, peak = run_in_process(run_stage, stage, folder, opts.repeat)
+
+            results["stages"][stage] = {"seconds": seconds, "messages": messages,
+                "messages_per_second": messages / seconds, "peak_memory": peak}
+
+            timed_print("{0}: {1:.3f}s ({2:.0f} messages/s, peak RSS: {3} MB)".format(stage, seconds,
+                messages / seconds, peak // 2 ** 20))
+    finally:
+        shutil.rmtree(folder)
+
+    if opts.results:
+        with open(opts.results, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+        timed_print("Results written to {0}".format(opts.results))
+
+
+def run_in_process(function, *args):
+    """
+    Calls a function in a new process and returns its result
+    """
+    pool = Pool(1, initializer=disable_progress)
+
+    try:
+        return pool.apply(function, args)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def prepare_pipeline(folder):
+    """
+    Writes the XML files of the synthetic dataset of a folder to its conversations subfolder
+    """
+    os.mkdir(os.path.join(folder, "conversations"))
+
+    data = extract_data(os.path.join(folder, "email"), os.path.join(folder, "forum"))
+
+    for i, conversation in enumerate(data):
+        save_to_file(make_xml(conversation), os.path.join(folder, "conversations", "x_{0}.xml".format(i + 1)))
+
+
+def run_stage(stage, folder, repeat):
+    """
+    Times a stage of the pipeline on the synthetic dataset of a folder, and returns its best time,
+    the number of messages processed and the peak memory of the process
+    """
+    email_folder, forum_folder = os.path.join(folder, "email"), os.path.join(folder, "forum")
+    xml_files = list_xml_files(os.path.join(folder, "conversations"))
+
+    if stage in ("extract_data", "xml_serialize"):
+        data = extract_data(email_folder, forum_folder)
+    else:
+        xmls = [read_source(xml_file) for xml_file in xml_files]
+        data = [Conversation(xml) for xml in xmls]
+
+    messages = sum(len(conversation.messages) for conversation in data)
+
+    if stage in ("segmentation", "xml_to_tsv", "xml_to_txt", "xml_to_html"):
+        load_tokenizer()
+
+    if stage == "extract_data":
+        function = lambda: extract_data(email_folder, forum_folder)
+    elif stage == "xml_serialize":
+        function = lambda: [make_xml(conversation) for conversation in data]
+    elif stage == "xml_unserialize":
+        function = lambda: [Conversation(xml) for xml in xmls]
+    elif stage == "segmentation":
+        function = lambda: [segment_messages(conversation) for conversation in data]
+    else:
+        converter = __import__(stage)
+        function = lambda: [converter.convert_file(xml_file) for xml_file in xml_files]
+
+    return best_time(function, repeat), messages, peak_memory()
+
+
+def make_conversation(n_messages, body_lines=8):
+    """
+    Builds a synthetic forum conversation
+    """
+    conversation = Conversation()
+    conversation.subject = u"Problème de connexion"
+    conversation.category = u"Réseau"
+    conversation.status = "open"
+
+    for i in range(n_messages):
+        message = Message()
+        message.medium = "forum"
+        message.conversation_id = conversation.id
+        message.subject = conversation.subject
+        message.daytime = "2015-04-07 12:{0:02d}".format(i % 60)
+        message.encoding = "UTF-8"
+        message.MIME = "text/html"
+        message.body = make_body(i, body_lines)
+
+        participant = Participant()
+        participant.user_name = u"user{0}".format(i % 50)
+        participant.description = str(i % 50)
+
+        message.participant_from.append(participant)
+
+        if i:
+            message.participant_to.append(conversation.messages[-1].participant_from[0])
+
+        conversation.messages.append(message)
+
+    return conversation
+
+
+def make_body(number, lines, distinct=False):
+    """
+    Builds a message body with a greeting, wrapped lines, HTML breaks, a quote and a signature,
+    the HTML lines being the same in every body unless distinct is set
+    """
+    body = [u"Bonjour,", u"> Le message précédent, cité.", u""]
+
+    for j in range(lines):
+        if j % 3:
+            body.append(u"Ligne {0} du message {1}, ça ne marche toujours pas. Avez-vous essayé de redémarrer la box ?".format(j, number))
+        else:
+            body.append(u"Merci.<br>Voir la page {0}{1}.</p>".format(j, u" du message {0}".format(number) if distinct else u""))
+
+    body.extend([u"Cordialement", u"--", u"Signature de l'utilisateur {0}".format(number % 50)])
+
+    return u"\n".join(body)
+
+
+def make_xml(conversation):
+    """
+    Serializes a conversation the way normalizer.py does
+    """
+    return conversation_xml(conversation)
+
+
+def snapshot(conversation):
+    """
+    Returns the loaded values of a conversation as nested tuples, for comparisons
+    """
+    messages = []
+
+    for message in conversation.messages:
+        participants = tuple(tuple(getattr(p, field) for field in PARTICIPANT_FIELDS)
+            for p in message.participant_from + message.participant_to)
+
+        messages.append((tuple(getattr(message, field) for field in MESSAGE_FIELDS), participants))
+
+    return tuple(getattr(conversation, field) for field in CONVERSATION_FIELDS), tuple(messages)
+
+
+def deep_sizeof(obj, seen=None):
+    """
+    Returns the size in bytes of an object and of everything it references, counting shared objects once
+    """
+    if seen is None:
+        seen = set()
+
+    if id(obj) in seen:
+        return 0
+
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(key, seen) + deep_sizeof(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    elif hasattr(obj, "__dict__"):
+        size += deep_sizeof(obj.__dict__, seen)
+    elif hasattr(obj, "__slots__"):
+        size += sum(deep_sizeof(getattr(obj, slot), seen) for slot in obj.__slots__)
+
+    return size
+
+
+def best_time(function, repeat):
+    """
+    Returns the best wall time of several calls
+    """
+    times = []
+
+    for i in range(repeat):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+
+    return min(times)
+
+
+def report(name, seconds, messages):
+    timed_print("{0}: {1:.3f}s ({2:.0f} messages/s)".format(name, seconds, messages / seconds))
+
+
+def xmltodict_unserialize(xml):
+    """
+    Former xmltodict-based implementation of Conversation.xml_unserialize, kept as a baseline
+    """
+    conversation = Conversation()
+
+    c_data = xmltodict.parse(xml)["conversation"]
+
+    conversation.id = c_data["@id"]
+    conversation.subject = c_data["subject"]
+    conversation.category = c_data["category"]
+    conversation.views = 0 if isinstance(c_data["views"], basestring) else int(c_data["views"])
+    conversation.status = c_data["status"]
+
+    if not isinstance(c_data["messages"]["message"], list):
+        messages = [c_data["messages"]["message"]]
+    else:
+        messages = c_data["messages"]["message"]
+
+    for m_data in messages:
+        m = Message()
+
+        m.id = m_data["@id"]
+        m.conversation_id = m_data["@conversationId"] if "@conversationId" in m_data else -1
+        m.medium = m_data["context"]["medium"]
+        m.private = m_data["context"]["private"]
+        m.likes = m_data["context"]["likes"]
+        m.views = m_data["context"]["views"]
+        m.importance = m_data["context"]["importance"]
+        m.subject = m_data["header"]["subject"]
+        m.daytime = m_data["header"]["daytime"] if "daytime" in m_data["header"] else m_data["header"]["date"]
+        m.encoding = m_data["header"]["encoding"]
+        m.MIME = m_data["header"]["MIME"]
+        m.body = m_data["content"]["body"]
+        m.form = m_data["content"]["form"]
+        m.kbitems = m_data["content"]["kbitems"] if "kbitems" in m_data["content"] else None
+        m.analysis = m_data["analysis"]
+
+        m.participant_from = [xmltodict_participant(m_data["header"]["from"]["participant"])]
+
+        if m_data["header"]["to"]:
+            m.participant_to = [xmltodict_participant(m_data["header"]["to"]["participant"])]
+
+        conversation.messages.append(m)
+
+    return conversation
+
+
+def xmltodict_participant(p_data):
+    p = Participant()
+
+    p.id = p_data["@id"]
+    p.role = p_data["@role"]
+    p.real_name = p_data["@realname"]
+    p.user_name = p_data["@username"]
+    p.email = p_data["@email"]
+    p.description = p_data["@description"]
+
+    return p
+
+
+class LegacyMessage:
+    """
+    Former dict-based message, allocating every container up front, kept as a baseline
+    """
+
+    def __init__(self):
+        self.id = id(self)
+        self.conversation_id = None
+        self.medium = ""
+        self.private = False
+        self.likes = 0
+        self.views = 0
+        self.importance = ""
+        self.subject = ""
+        self.daytime = None
+        self.encoding = ""
+        self.MIME = ""
+        self.participant_from = []
+        self.participant_to = []
+        self.participant_cc = []
+        self.participant_bcc = []
+        self.body = ""
+        self.form = {}
+        self.kbitems = []
+        self.analysis = None
+        self.misc = {}
+
+
+class LegacyParticipant:
+    """
+    Former dict-based participant, kept as a baseline
+    """
+
+    def __init__(self):
+        self.id = id(self)
+        self.role = ""
+        self.real_name = ""
+        self.user_name = ""
+        self.email = ""
+        self.description = ""
+        self.misc = {}
+
+
+def legacy_message(message):
+    """
+    Copies a loaded message into the former classes, as the loader used to build it
+    """
+    m = LegacyMessage()
+
+    for field in MESSAGE_FIELDS:
+        setattr(m, field, getattr(message, field))
+
+    m.participant_from = [legacy_participant(p) for p in message.participant_from]
+
+    if message.participant_to:
+        m.participant_to = [legacy_participant(p) for p in message.participant_to]
+
+    return m
+
+
+def legacy_participant(participant):
+    p = LegacyParticipant()
+
+    for field in PARTICIPANT_FIELDS:
+        setattr(p, field, getattr(participant, field))
+
+    return p
+
+
+def legacy_segment(text):
+    """
+    Former segmentation of the converters, kept as a baseline
+    """
+    lines = text.split("\n")
+    lines = [l.strip() for l in lines if not l.strip().startswith(">") and len(l.strip()) > 0]
+
+    true_lines = []
+
+    for line in lines:
+        if line.startswith("--"):
+            break
+
+        if line.startswith(">") or not len(line) > 0:
+            continue
+
+        line = line.replace("<br>", "<br>\n")
+        line = line.replace("</p>", "</p>\n")
+
+        if len(line) < 65 and len(line) > 0:
+            line += "\n"
+        else:
+            line += " "
+
+        true_lines.append(line)
+
+    true_lines = "".join(true_lines).split("\n")
+
+    sentences = []
+
+    for line in true_lines:
+        if len(line.strip()) == 0:
+            continue
+
+        tokens = load_tokenizer().tokenize(line)
+
+        for token in tokens:
+            sentences.append(token)
+
+    return sentences
+
+
+BENCHMARKS = {
+    "memory": bench_memory,
+    "pipeline": bench_pipeline,
+    "segmentation": bench_segmentation,
+    "serialize": bench_serialize,
+    "startup": bench_startup,
+    "unserialize": bench_unserialize,
+}
+
+
+def parse_args():
+    """
+     Parse command line opts and arguments
+    """
+
+    op = OptionParser(usage="usage: %prog [opts] [benchmark...]\n\nbenchmarks: {0}".format(", ".join(sorted(BENCHMARKS))))
+
+    op.add_option("--test",
+        dest="test",
+        default=False,
+        action="store_true",
+        help="executes the test suite")
+
+    op.add_option("--messages",
+        dest="messages",
+        default=5000,
+        type="int",
+        help="number of messages of the synthetic conversation (default: 5000)")
+
+    op.add_option("--repeat",
+        dest="repeat",
+        default=3,
+        type="int",
+        help="number of timed runs, the best one being kept (default: 3)")
+
+    op.add_option("--scale",
+        dest="scale",
+        default=1,
+        type="int",
+        help="size of the synthetic dataset of the pipeline benchmark, 1 being 3500 messages (default: 1)")
+
+    op.add_option("--results",
+        dest="results",
+        default=None,
+        type="string",
+        help="JSON file receiving the results of the pipeline benchmark")
+
+    op.add_option("--max-startup",
+        dest="max_startup",
+        default=None,
+        type="float",
+        help="maximum startup time of a script in seconds, above which the startup benchmark fails")
+
+    return op.parse_args()
+
+
+if __name__ == "__main__":
+    options, arguments = parse_args()
+
+    for argument in arguments:
+        if argument not in BENCHMARKS:
+            raise SystemExit("Unknown benchmark: {0}".format(argument))
+
+    if options.test:
+        doctest.testmod() # unit testing
+    else:
+        benchmark(options, arguments)
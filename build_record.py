@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+:Name:
+    build_record.py
+
+:Authors:
+    Soufian Salim (soufi@nsal.im)
+"""
+
+import hashlib
+import json
+import os
+
+from shards import split_member, open_shard
+from utility import timed_print, file_hash
+
+
+CHECKS = ["mtime", "hash"]
+
+
+class BuildRecord(object):
+    """
+    Sidecar file remembering the state of each source file when it was last converted, so that
+    only the sources changed since, or whose outputs are missing, are converted again
+
+    Sources are compared by modification time and size, or by content hash with check="hash".
+    Changing settings (e.g. the converter options) makes every source stale.
+    """
+
+    def __init__(self, path, settings=None, check="mtime"):
+        if check not in CHECKS:
+            raise ValueError("Unknown check: {0}".format(check))
+
+        self.path = path
+        self.settings = settings
+        self.check = check
+        self.folder = os.path.dirname(path)
+        self.states = {}
+        self.pending = {}
+
+        if os.path.exists(path):
+            with open(path) as f:
+                record = json.load(f)
+
+            if record["settings"] == settings:
+                self.states = record["sources"]
+
+
+    def state(self, source):
+        """
+        Returns the current state of a source file, as stored in the record
+        """
+        path, name = split_member(source)
+
+        if self.check == "hash":
+            if name is not None:
+                return hashlib.sha1(open_shard(path).read(name)).hexdigest()
+
+            return file_hash(source)
+
+        # the documents of a shard change together with the shard
+        stat = os.stat(path)
+
+        return [stat.st_mtime, stat.st_size]
+
+
+    def stale_files(self, sources, outputs):
+        """
+        Returns the sources that need converting, outputs giving the output paths of a source
+        """
+        stale = []
+
+        for source in sources:
+            key = os.path.relpath(source, self.folder)
+            state = self.state(source)
+
+            if self.states.get(key) != state or not all(os.path.exists(output) for output in outputs(source)):
+                self.pending[key] = state
+                stale.append(source)
+
+        return stale
+
+
+    def commit(self, converted):
+        """
+        Records the state the converted sources had when selected, and saves the record
+        """
+        for source in converted:
+            key = os.path.relpath(source, self.folder)
+
+            self.states[key] = self.pending.pop(key)
+
+        with open(self.path + ".part", "w") as f:
+            json.dump({"settings": self.settings, "sources": self.states}, f, sort_keys=True)
+
+        os.rename(self.path + ".part", self.path)
+
+
+def record_path(input_folder, name):
+    """
+    Returns the path of the record a converter keeps in its input folder
+    """
+    return os.path.join(input_folder, ".{0}.record.json".format(name))
+
+
+def convert_stale(record, sources, outputs, convert):
+    """
+    Runs convert, a function taking a list of files and returning the (filename, error) pairs
+    of failures, on the stale sources only, then records the successful ones and reports counts
+    """
+    stale = record.stale_files(sources, outputs)
+
+    failures = convert(stale)
+
+    failed = set(filename for filename, error in failures)
+
+    record.commit([source for source in stale if source not in failed])
+
+    timed_print("Converted {0} files, skipped {1} up-to-date files".format(len(stale) - len(failed), len(sources) - len(stale)))
+
+    return failures
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+:Name:
+    compression.py
+
+:Authors:
+    Soufian Salim (soufi@nsal.im)
+"""
+
+import bz2
+import gzip
+import io
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma # python 2 backport, only needed for .xz files
+    except ImportError:
+        lzma = None
+
+
+COMPRESSIONS = ["gz", "bz2", "xz"]
+
+DEFAULT_LEVEL = 6
+
+
+def open_file(filepath, mode="rb", level=DEFAULT_LEVEL):
+    """
+    Opens a file in binary mode, compressing or decompressing it on the fly when its extension
+    is .gz, .bz2 or .xz
+    """
+    compression = compression_of(filepath)
+
+    if compression == "gz":
+        return gzip.GzipFile(filepath, mode, compresslevel=level)
+
+    if compression == "bz2":
+        return bz2.BZ2File(filepath, mode, compresslevel=max(level, 1))
+
+    if compression == "xz":
+        if lzma is None:
+            raise ImportError("Reading and writing .xz files requires the lzma module (backports.lzma on python 2)")
+
+        if "r" in mode:
+            return lzma.LZMAFile(filepath, mode)
+
+        return lzma.LZMAFile(filepath, mode, preset=level)
+
+    return io.open(filepath, mode)
+
+
+def compression_of(filepath):
+    """
+    Returns the compression of a file given by its extension, or None
+    """
+    extension = filepath.rsplit(".", 1)[-1]
+
+    return extension if extension in COMPRESSIONS else None
+
+
+def compressed_filename(filepath, compression=None):
+    """
+    Returns a path with its compression extension replaced by the given one, or removed
+    """
+    if compression_of(filepath):
+        filepath = filepath.rsplit(".", 1)[0]
+
+    return "{0}.{1}".format(filepath, compression) if compression else filepath
@@ -7,11 +7,65 @@
 """
 
 
+import hashlib
+import io
 import xml.etree.cElementTree as ET
-import xmltodict
 
 
-class Conversation:
+class FrozenDict(dict):
+    """
+    Immutable empty dictionary shared as the default of unused mappings
+    """
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("shared empty default, assign a new dict instead")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _immutable
+
+    def __reduce__(self):
+        return "EMPTY_DICT" # unpickled as the shared instance
+
+
+EMPTY_LIST = ()
+
+EMPTY_DICT = FrozenDict()
+
+
+class LazyContainer(object):
+    """
+    Attribute stored in a slot that holds a shared immutable empty value until first accessed,
+    when the object gets its own container
+    """
+
+    def __init__(self, slot, empty, factory):
+        self.slot = slot
+        self.empty = empty
+        self.factory = factory
+
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+
+        value = getattr(obj, self.slot)
+
+        if value is self.empty:
+            value = self.factory()
+            setattr(obj, self.slot, value)
+
+        return value
+
+
+    def __set__(self, obj, value):
+        setattr(obj, self.slot, value)
+
+
+class Conversation(object):
+    __slots__ = ("id", "subject", "category", "views", "status", "messages", "_analysis", "_misc")
+
+    analysis = LazyContainer("_analysis", EMPTY_DICT, dict)
+    misc = LazyContainer("_misc", EMPTY_DICT, dict)
+
     def __init__(self, xml=None):
         self.id = id(self)
         self.subject = ""
@@ -19,8 +73,8 @@ class Conversation:
         self.views = 0
         self.status = ""
         self.messages = []
-        self.analysis = {}
-        self.misc = {}
+        self._analysis = EMPTY_DICT
+        self._misc = EMPTY_DICT
 
         if xml:
             self.xml_unserialize(xml)
@@ -35,10 +89,10 @@ class Conversation:
         ET.SubElement(conversation, "views").text = str(self.views)
         ET.SubElement(conversation, "status").text = self.status
 
-        if self.misc:
+        if self._misc:
             misc = ET.SubElement(conversation, "misc")
 
-            for key, value in self.misc.items():
+            for key, value in self._misc.items():
                 item = ET.SubElement(misc, "item")
                 item.set("name", key)
                 item.set("value", value)
@@ -51,66 +105,101 @@ class Conversation:
         return conversation
 
 
-    def xml_unserialize(self, xml):
-        c_data = xmltodict.parse(xml)["conversation"]
+    def xml_write(self, f):
+        """
+        Writes the XML of the conversation to a file object, with the bytes of
+        ET.tostring(self.xml_serialize()) but without building the element tree
+
+        The fragments of each message are joined before being written, as small writes are slow
+        on compressed files.
+        """
+        fragments = []
+        write = fragments.append
+
+        write("<conversation id=\"" + escape_attrib(str(self.id)) + "\">")
+        write_element(write, "subject", self.subject)
+        write_element(write, "category", self.category)
+        write_element(write, "views", str(self.views))
+        write_element(write, "status", self.status)
+        write_misc(write, self._misc)
+
+        if self.messages:
+            write("<messages>")
 
-        self.id = c_data["@id"]
-        self.subject = c_data["subject"]
-        self.category = c_data["category"]
-        self.views = 0 if isinstance(c_data["views"], basestring) else int(c_data["views"])
-        self.status = c_data["status"]
+            for message in self.messages:
+                message.xml_write(write)
 
-        if not isinstance(c_data["messages"]["message"], list):
-            messages = [c_data["messages"]["message"]]
+                f.write("".join(fragments))
+                del fragments[:]
+
+            write("</messages>")
         else:
-            messages = c_data["messages"]["message"]
-
-        for m_data in messages:
-            m = Message()
-
-            m.id = m_data["@id"]
-            m.conversation_id = m_data["@conversationId"] if "@conversationId" in m_data else -1
-            m.medium = m_data["context"]["medium"]
-            m.private = m_data["context"]["private"]
-            m.likes = m_data["context"]["likes"]
-            m.views = m_data["context"]["views"]
-            m.importance = m_data["context"]["importance"]
-            m.subject = m_data["header"]["subject"]
-            m.daytime = m_data["header"]["daytime"] if "daytime" in m_data["header"] else m_data["header"]["date"]
-            m.encoding = m_data["header"]["encoding"]
-            m.MIME = m_data["header"]["MIME"]
-            m.body = m_data["content"]["body"]
-            m.form = m_data["content"]["form"]
-            m.kbitems = m_data["content"]["kbitems"] if "kbitems" in m_data["content"] else None
-            m.analysis = m_data["analysis"]
-
-            p_from = Participant()
-
-            p_from.id = m_data["header"]["from"]["participant"]["@id"]
-            p_from.role = m_data["header"]["from"]["participant"]["@role"]
-            p_from.real_name = m_data["header"]["from"]["participant"]["@realname"]
-            p_from.user_name = m_data["header"]["from"]["participant"]["@username"]
-            p_from.email = m_data["header"]["from"]["participant"]["@email"]
-            p_from.description = m_data["header"]["from"]["participant"]["@description"]
-
-            m.participant_from = [p_from]
-
-            if m_data["header"]["to"]:
-                p_to = Participant()
-
-                p_to.id = m_data["header"]["to"]["participant"]["@id"]
-                p_to.role = m_data["header"]["to"]["participant"]["@role"]
-                p_to.real_name = m_data["header"]["to"]["participant"]["@realname"]
-                p_to.user_name = m_data["header"]["to"]["participant"]["@username"]
-                p_to.email = m_data["header"]["to"]["participant"]["@email"]
-                p_to.description = m_data["header"]["to"]["participant"]["@description"]
-
-                m.participant_to = [p_to]
-
-            self.messages.append(m)
-
-
-class Message:
+            write("<messages />")
+
+        write("</conversation>")
+
+        f.write("".join(fragments))
+
+
+    def xml_unserialize(self, xml):
+        if isinstance(xml, unicode):
+            xml = xml.encode("utf-8")
+
+        self.xml_load(io.BytesIO(xml))
+
+
+    def xml_load(self, source):
+        """
+        Fills the conversation from an XML file or file object, building one message at a time
+        """
+        depth = 0
+        participants = {}
+
+        for event, element in ET.iterparse(source, events=("start", "end")):
+            if event == "start":
+                if depth == 0:
+                    self.id = unicode(element.get("id"))
+
+                depth += 1
+
+                continue
+
+            depth -= 1
+
+            if depth == 2 and element.tag == "message":
+                self.messages.append(load_message(element, participants))
+
+                element.clear()
+            elif depth == 1:
+                tag = element.tag
+
+                if tag == "subject":
+                    self.subject = element_text(element)
+                elif tag == "category":
+                    self.category = element_text(element)
+                elif tag == "views":
+                    views = element_text(element)
+
+                    self.views = 0 if isinstance(views, basestring) else int(views)
+                elif tag == "status":
+                    self.status = element_text(element)
+
+                element.clear()
+
+
+class Message(object):
+    __slots__ = ("id", "conversation_id", "medium", "private", "likes", "views", "importance", "subject",
+        "daytime", "encoding", "MIME", "_participant_from", "_participant_to", "_participant_cc",
+        "_participant_bcc", "body", "_form", "_kbitems", "analysis", "_misc")
+
+    participant_from = LazyContainer("_participant_from", EMPTY_LIST, list)
+    participant_to = LazyContainer("_participant_to", EMPTY_LIST, list)
+    participant_cc = LazyContainer("_participant_cc", EMPTY_LIST, list)
+    participant_bcc = LazyContainer("_participant_bcc", EMPTY_LIST, list)
+    form = LazyContainer("_form", EMPTY_DICT, dict)
+    kbitems = LazyContainer("_kbitems", EMPTY_LIST, list)
+    misc = LazyContainer("_misc", EMPTY_DICT, dict)
+
     def __init__(self):
         self.id = id(self)
         self.conversation_id = None
@@ -123,15 +212,15 @@ class Message:
         self.daytime = None
         self.encoding = ""
         self.MIME = ""
-        self.participant_from = []
-        self.participant_to = []
-        self.participant_cc = []
-        self.participant_bcc = []
+        self._participant_from = EMPTY_LIST
+        self._participant_to = EMPTY_LIST
+        self._participant_cc = EMPTY_LIST
+        self._participant_bcc = EMPTY_LIST
         self.body = ""
-        self.form = {}
-        self.kbitems = []
+        self._form = EMPTY_DICT
+        self._kbitems = EMPTY_LIST
         self.analysis = None
-        self.misc = {}
+        self._misc = EMPTY_DICT
 
 
     def xml_serialize(self):
@@ -142,8 +231,8 @@ class Message:
 
         in_reply_to = ""
 
-        if (len(self.participant_to) > 0):
-            in_reply_to = str(self.participant_to[0].email)
+        if (len(self._participant_to) > 0):
+            in_reply_to = str(self._participant_to[0].email)
 
         message.set("inReplyTo", in_reply_to)
 
@@ -164,30 +253,30 @@ class Message:
 
         participant_from = ET.SubElement(header, "from")
 
-        for participant in self.participant_from:
+        for participant in self._participant_from:
             participant_from.append(participant.xml_serialize())
 
         participant_to = ET.SubElement(header, "to")
 
-        for participant in self.participant_to:
+        for participant in self._participant_to:
             participant_to.append(participant.xml_serialize())
 
         participant_cc = ET.SubElement(header, "cc")
 
-        for participant in self.participant_cc:
+        for participant in self._participant_cc:
             participant_cc.append(participant.xml_serialize())
 
         participant_bcc = ET.SubElement(header, "bcc")
 
-        for participant in self.participant_bcc:
+        for participant in self._participant_bcc:
             participant_bcc.append(participant.xml_serialize())
 
             ET.SubElement(header, "meta")
 
-        if self.misc:
+        if self._misc:
             misc = ET.SubElement(message, "misc")
 
-            for key, value in self.misc.items():
+            for key, value in self._misc.items():
                 item = ET.SubElement(misc, "item")
                 item.set("name", key)
                 item.set("value", value)
@@ -203,7 +292,60 @@ class Message:
         return message
 
 
-class Participant:
+    def xml_write(self, write):
+        """
+        Passes the fragments of the XML of the message to write, as xml_serialize would be serialized
+        """
+        in_reply_to = ""
+
+        if (len(self._participant_to) > 0):
+            in_reply_to = str(self._participant_to[0].email)
+
+        write("<message conversationId=\"" + escape_attrib(str(self.conversation_id)) + "\" id=\"" +
+            escape_attrib(str(self.id)) + "\" inReplyTo=\"" + escape_attrib(in_reply_to) + "\"><context>")
+
+        write_element(write, "medium", self.medium)
+        write_element(write, "private", str(self.private).lower())
+        write_element(write, "likes", str(self.likes))
+        write_element(write, "views", str(self.views))
+        write_element(write, "importance", self.importance)
+
+        write("</context><header>")
+
+        write_element(write, "subject", self.subject)
+        write_element(write, "daytime", self.daytime)
+        write_element(write, "encoding", self.encoding)
+        write_element(write, "MIME", self.MIME)
+
+        for tag, participants in (("from", self._participant_from), ("to", self._participant_to),
+                ("cc", self._participant_cc), ("bcc", self._participant_bcc)):
+            if participants:
+                write("<" + tag + ">")
+
+                for participant in participants:
+                    participant.xml_write(write)
+
+                write("</" + tag + ">")
+            else:
+                write("<" + tag + " />")
+
+        # xml_serialize adds a meta element to the header for each bcc participant
+        write("<meta />" * len(self._participant_bcc))
+
+        write("</header>")
+
+        write_misc(write, self._misc)
+
+        write("<content>")
+        write_element(write, "body", self.body)
+        write("<form /><attachments /><kbitems /></content><analysis /></message>")
+
+
+class Participant(object):
+    __slots__ = ("id", "role", "real_name", "user_name", "email", "description", "_misc")
+
+    misc = LazyContainer("_misc", EMPTY_DICT, dict)
+
     def __init__(self):
         self.id = id(self)
         self.role = ""
@@ -211,7 +353,7 @@ class Participant:
         self.user_name = ""
         self.email = ""
         self.description = ""
-        self.misc = {}
+        self._misc = EMPTY_DICT
 
 
     def xml_serialize(self):
@@ -224,12 +366,254 @@ class Participant:
         participant.set("email", self.email)
         participant.set("description", self.description)
 
-        if self.misc:
+        if self._misc:
             misc = ET.SubElement(participant, "misc")
 
-            for key, value in self.misc.items():
+            for key, value in self._misc.items():
                 item = ET.SubElement(misc, "item")
                 item.set("name", key)
                 item.set("value", value)
 
-        return participant
\ No newline at end of file
+        return participant
+
+
+    def xml_write(self, write):
+        """
+        Passes the fragments of the XML of the participant to write, as xml_serialize would be serialized
+        """
+        write("<participant description=\"" + escape_attrib(self.description) + "\" email=\"" +
+            escape_attrib(self.email) + "\" id=\"" + escape_attrib(str(self.id)) + "\" realname=\"" +
+            escape_attrib(self.real_name) + "\" role=\"" + escape_attrib(self.role) + "\" username=\"" +
+            escape_attrib(self.user_name) + "\"")
+
+        if self._misc:
+            write(">")
+            write_misc(write, self._misc)
+            write("</participant>")
+        else:
+            write(" />")
+
+
+class ParticipantRegistry(object):
+    """
+    Interns participants, returning one shared instance per email address or forum author, whose
+    id is derived from that key and therefore stable across runs
+
+    The normalizer uses one registry per input file, so that a file gives the same output whichever
+    files are parsed before it or in which process: an author of several files is a separate instance
+    in each, with the same id, and the name kept is the first one seen in that file. Sharing saves
+    memory and gives stable ids, but the XML still repeats a participant in every message.
+
+    A participant without an address or author id is not interned and keeps the default id, its
+    memory address, which another participant may get once it is freed: such ids are only unique
+    within a conversation, so writers storing participants once tell them apart by all their fields.
+    """
+
+    def __init__(self):
+        self.participants = {}
+
+
+    def email(self, address, real_name=""):
+        """
+        Returns the participant of an email address, created with real_name on first sight
+        """
+        key = u"email:{0}".format(address.strip().lower()) if address else None
+
+        participant = self.intern(key)
+
+        if not participant.email:
+            participant.real_name = real_name
+            participant.email = address
+
+        return participant
+
+
+    def forum(self, author_id, user_name=""):
+        """
+        Returns the participant of a forum author id, created with user_name on first sight
+        """
+        key = u"forum:{0}".format(author_id) if author_id is not None else None
+
+        participant = self.intern(key)
+
+        if not participant.description:
+            participant.user_name = user_name
+            participant.description = str(author_id)
+
+        return participant
+
+
+    def intern(self, key):
+        """
+        Returns the participant registered under key, registering a blank one if needed, or an
+        unregistered blank participant when there is no key
+        """
+        if key is None:
+            return Participant()
+
+        participant_id = key_id(key)
+
+        participant = self.participants.get(participant_id)
+
+        if participant is None:
+            participant = self.participants[participant_id] = Participant()
+            participant.id = participant_id
+
+        return participant
+
+
+    def get(self, participant_id):
+        """
+        Returns the interned participant with the given id, or None
+        """
+        return self.participants.get(participant_id)
+
+
+    def __len__(self):
+        return len(self.participants)
+
+
+def key_id(key):
+    """
+    Returns a short stable identifier of a registry key
+    """
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+
+def load_message(element, participants=None):
+    """
+    Builds a message from its XML element, with the same values xmltodict used to give
+
+    Participants already in the participants dictionary, keyed by id, are shared instead of copied.
+    """
+    m = Message()
+
+    m.id = unicode(element.get("id"))
+    m.conversation_id = unicode(element.get("conversationId")) if "conversationId" in element.attrib else -1
+
+    children = dict((child.tag, child) for child in element)
+
+    context = dict((child.tag, element_text(child)) for child in children["context"])
+
+    m.medium = context["medium"]
+    m.private = context["private"]
+    m.likes = context["likes"]
+    m.views = context["views"]
+    m.importance = context["importance"]
+
+    header = dict((child.tag, child) for child in children["header"])
+
+    m.subject = element_text(header["subject"])
+    m.daytime = element_text(header["daytime"] if "daytime" in header else header["date"])
+    m.encoding = element_text(header["encoding"])
+    m.MIME = element_text(header["MIME"])
+
+    content = dict((child.tag, element_text(child)) for child in children["content"])
+
+    m.body = content["body"]
+    m.form = content["form"]
+    m.kbitems = content["kbitems"] if "kbitems" in content else None
+    m.analysis = element_text(children["analysis"])
+
+    m.participant_from = [load_participant(header["from"][0], participants)]
+
+    if "to" in header and len(header["to"]):
+        m.participant_to = [load_participant(header["to"][0], participants)]
+
+    return m
+
+
+def load_participant(element, participants=None):
+    """
+    Builds a participant from its XML element, or returns the one of the same id in participants
+    """
+    if participants is not None and element.get("id") in participants:
+        return participants[element.get("id")]
+
+    p = Participant()
+
+    p.id = unicode(element.get("id"))
+    p.role = unicode(element.get("role"))
+    p.real_name = unicode(element.get("realname"))
+    p.user_name = unicode(element.get("username"))
+    p.email = unicode(element.get("email"))
+    p.description = unicode(element.get("description"))
+
+    if participants is not None:
+        participants[element.get("id")] = p
+
+    return p
+
+
+def write_element(write, tag, text):
+    """
+    Passes an element holding text to write, as ElementTree serializes it
+    """
+    if text:
+        write("<" + tag + ">" + escape_cdata(text) + "</" + tag + ">")
+    else:
+        write("<" + tag + " />")
+
+
+def write_misc(write, misc):
+    """
+    Passes the misc element of a mapping to write, if it is not empty
+    """
+    if misc:
+        write("<misc>")
+
+        for key, value in misc.items():
+            write("<item name=\"" + escape_attrib(key) + "\" value=\"" + escape_attrib(value) + "\" />")
+
+        write("</misc>")
+
+
+def escape_cdata(text):
+    """
+    Escapes text as ElementTree does when serializing to us-ascii, non-ASCII characters becoming
+    character references
+    """
+    try:
+        if "&" in text:
+            text = text.replace("&", "&amp;")
+        if "<" in text:
+            text = text.replace("<", "&lt;")
+        if ">" in text:
+            text = text.replace(">", "&gt;")
+
+        return text.encode("us-ascii", "xmlcharrefreplace")
+    except (TypeError, AttributeError):
+        raise TypeError("cannot serialize {0!r} (type {1})".format(text, type(text).__name__))
+
+
+def escape_attrib(text):
+    """
+    Escapes an attribute value as ElementTree does when serializing to us-ascii
+    """
+    try:
+        if "&" in text:
+            text = text.replace("&", "&amp;")
+        if "<" in text:
+            text = text.replace("<", "&lt;")
+        if ">" in text:
+            text = text.replace(">", "&gt;")
+        if "\"" in text:
+            text = text.replace("\"", "&quot;")
+        if "\n" in text:
+            text = text.replace("\n", "&#10;")
+
+        return text.encode("us-ascii", "xmlcharrefreplace")
+    except (TypeError, AttributeError):
+        raise TypeError("cannot serialize {0!r} (type {1})".format(text, type(text).__name__))
+
+
+def element_text(element):
+    """
+    Returns the stripped text of an element, or None if it is empty
+    """
+    text = element.text
+
+    if text:
+        text = text.strip()
+
+    return unicode(text) if text else None
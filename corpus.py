@@ -0,0 +1,448 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+:Name:
+    corpus.py
+
+:Authors:
+    Soufian Salim (soufi@nsal.im)
+"""
+
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import zlib
+
+from conversations import Conversation, Message, Participant
+from utility import to_int
+
+
+MAGIC = b"ODCORPUS"
+
+VERSION = 1
+
+# magic, version, then the number of conversations, messages and participants, the sizes of the
+# two hash tables and the offsets of the sections: conversations, messages, participants,
+# conversation table, message table and string heap
+HEADER = struct.Struct("<8sI3I2I6Q")
+
+# strings are stored as their offset and length in the heap, this length standing for None
+NONE_LENGTH = 0xffffffff
+
+NO_PARTICIPANT = -1
+
+# field kinds: "s" string, "j" JSON-encoded string, "i" integer, "b" boolean,
+# "p" participant index (a list of at most one participant when read), "m" message index
+FORMATS = {"s": "QI", "j": "QI", "i": "q", "b": "?", "p": "i", "m": "I"}
+
+CONVERSATION_FIELDS = [("id", "s"), ("subject", "s"), ("category", "s"), ("views", "i"), ("status", "s"),
+    ("misc", "j"), ("first_message", "m"), ("message_count", "m")]
+
+MESSAGE_FIELDS = [("id", "s"), ("conversation_id", "s"), ("medium", "s"), ("private", "b"), ("likes", "i"),
+    ("views", "i"), ("importance", "s"), ("subject", "s"), ("daytime", "s"), ("encoding", "s"), ("MIME", "s"),
+    ("participant_from", "p"), ("participant_to", "p"), ("body", "s"), ("misc", "j")]
+
+PARTICIPANT_FIELDS = [("id", "s"), ("role", "s"), ("real_name", "s"), ("user_name", "s"), ("email", "s"),
+    ("description", "s"), ("misc", "j")]
+
+
+def record_struct(fields):
+    return struct.Struct("<" + "".join(FORMATS[kind] for name, kind in fields))
+
+
+CONVERSATION = record_struct(CONVERSATION_FIELDS)
+
+MESSAGE = record_struct(MESSAGE_FIELDS)
+
+PARTICIPANT = record_struct(PARTICIPANT_FIELDS)
+
+SLOT = struct.Struct("<I")
+
+
+class CorpusWriter(object):
+    """
+    Writes conversations to a packed corpus file: fixed-width conversation, message and
+    participant records, hash tables of the conversation and message ids, and a heap of strings
+
+    Records and strings are spooled to temporary files, then assembled by close().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.folder = tempfile.mkdtemp(prefix=".corpus", dir=os.path.dirname(os.path.abspath(path)))
+        self.sections = dict((name, open(os.path.join(self.folder, name), "w+b"))
+            for name in ("conversations", "messages", "participants", "heap"))
+        self.heap_size = 0
+        self.conversation_ids = []
+        self.message_ids = []
+        self.participants = {}
+
+
+    def add(self, conversation):
+        """
+        Appends a conversation, its messages and the participants not written yet
+        """
+        first_message = len(self.message_ids)
+
+        for message in conversation.messages:
+            values = self.pack_values(MESSAGE_FIELDS, {
+                "id": unicode(message.id),
+                "conversation_id": unicode(message.conversation_id),
+                "medium": message.medium,
+                "private": message.private in (True, "true"),
+                "likes": to_int(message.likes),
+                "views": to_int(message.views),
+                "importance": message.importance,
+                "subject": message.subject,
+                "daytime": message.daytime,
+                "encoding": message.encoding,
+                "MIME": message.MIME,
+                "participant_from": self.participant_index(message.participant_from),
+                "participant_to": self.participant_index(message.participant_to),
+                "body": message.body,
+                "misc": message.misc,
+            })
+
+            self.sections["messages"].write(MESSAGE.pack(*values))
+            self.message_ids.append(unicode(message.id))
+
+        values = self.pack_values(CONVERSATION_FIELDS, {
+            "id": unicode(conversation.id),
+            "subject": conversation.subject,
+            "category": conversation.category,
+            "views": to_int(conversation.views),
+            "status": conversation.status,
+            "misc": conversation.misc,
+            "first_message": first_message,
+            "message_count": len(conversation.messages),
+        })
+
+        self.sections["conversations"].write(CONVERSATION.pack(*values))
+        self.conversation_ids.append(unicode(conversation.id))
+
+
+    def participant_index(self, participants):
+        """
+        Returns the index of the first participant of a list, writing it on first sight
+        """
+        if not participants:
+            return NO_PARTICIPANT
+
+        participant = participants[0]
+
+        # one record per distinct participant, misc aside, shared by the message records indexing it
+        key = tuple(getattr(participant, name) for name, kind in PARTICIPANT_FIELDS[:-1])
+
+        if key not in self.participants:
+            values = self.pack_values(PARTICIPANT_FIELDS, dict((name, getattr(participant, name))
+                for name, kind in PARTICIPANT_FIELDS))
+
+            self.sections["participants"].write(PARTICIPANT.pack(*values))
+            self.participants[key] = len(self.participants)
+
+        return self.participants[key]
+
+
+    def pack_values(self, fields, values):
+        """
+        Returns the struct values of a record, writing its strings to the heap
+        """
+        packed = []
+
+        for name, kind in fields:
+            value = values[name]
+
+            if kind == "j":
+                value = json.dumps(value, sort_keys=True) if value else None
+
+            if kind in "sj":
+                packed.extend(self.write_string(value))
+            else:
+                packed.append(value)
+
+        return packed
+
+
+    def write_string(self, value):
+        if value is None:
+            return 0, NONE_LENGTH
+
+        if not isinstance(value, unicode):
+            value = unicode(value)
+
+        data = value.encode("utf-8")
+        offset = self.heap_size
+
+        self.sections["heap"].write(data)
+        self.heap_size += len(data)
+
+        return offset, len(data)
+
+
+    def close(self):
+        """
+        Writes the corpus file and removes the temporary files
+        """
+        conversation_table = build_table(self.conversation_ids)
+        message_table = build_table(self.message_ids)
+
+        sizes = [len(self.conversation_ids) * CONVERSATION.size, len(self.message_ids) * MESSAGE.size,
+            len(self.participants) * PARTICIPANT.size, len(conversation_table) * SLOT.size,
+            len(message_table) * SLOT.size]
+
+        offsets = [HEADER.size]
+
+        for size in sizes:
+            offsets.append(offsets[-1] + size)
+
+        with open(self.path + ".part", "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(self.conversation_ids), len(self.message_ids),
+                len(self.participants), len(conversation_table), len(message_table), *offsets))
+
+            for name in ("conversations", "messages", "participants"):
+                self.sections[name].seek(0)
+                shutil.copyfileobj(self.sections[name], f)
+
+            for table in (conversation_table, message_table):
+                f.write(struct.pack("<{0}I".format(len(table)), *table))
+
+            self.sections["heap"].seek(0)
+            shutil.copyfileobj(self.sections["heap"], f)
+
+        for section in self.sections.values():
+            section.close()
+
+        shutil.rmtree(self.folder)
+
+        os.rename(self.path + ".part", self.path)
+
+
+class Corpus(object):
+    """
+    Read-only access to a packed corpus through mmap: conversations and messages are found by id
+    in constant time, and their fields are only decoded when read
+    """
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        header = HEADER.unpack_from(self.data, 0)
+
+        if header[0] != MAGIC or header[1] != VERSION:
+            raise ValueError("Not a corpus of version {0}: {1}".format(VERSION, path))
+
+        (self.conversation_count, self.message_count, self.participant_count,
+            self.conversation_slots, self.message_slots) = header[2:7]
+
+        (self.conversations_offset, self.messages_offset, self.participants_offset,
+            self.conversation_table_offset, self.message_table_offset, self.heap_offset) = header[7:]
+
+
+    def __len__(self):
+        return self.conversation_count
+
+
+    def __iter__(self):
+        for index in range(self.conversation_count):
+            yield ConversationRecord(self, index)
+
+
+    def conversation(self, conversation_id):
+        """
+        Returns the record of a conversation, or raises KeyError
+        """
+        index = self.lookup(conversation_id, ConversationRecord, self.conversation_table_offset, self.conversation_slots)
+
+        return ConversationRecord(self, index)
+
+
+    def message(self, message_id):
+        """
+        Returns the record of a message, or raises KeyError
+        """
+        index = self.lookup(message_id, MessageRecord, self.message_table_offset, self.message_slots)
+
+        return MessageRecord(self, index)
+
+
+    def lookup(self, record_id, record_class, table_offset, slots):
+        """
+        Returns the index of the record with the given id, probing the hash table linearly
+        """
+        record_id = unicode(record_id)
+        slot = id_hash(record_id) & (slots - 1)
+
+        while slots:
+            index = SLOT.unpack_from(self.data, table_offset + slot * SLOT.size)[0]
+
+            if index == 0:
+                break
+
+            if record_class(self, index - 1).id == record_id:
+                return index - 1
+
+            slot = (slot + 1) & (slots - 1)
+
+        raise KeyError(record_id)
+
+
+    def string(self, offset, length):
+        if length == NONE_LENGTH:
+            return None
+
+        start = self.heap_offset + offset
+
+        return self.data[start:start + length].decode("utf-8")
+
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+
+class Field(object):
+    """
+    Record attribute decoding one field from the corpus when read
+    """
+
+    def __init__(self, kind, position):
+        self.kind = kind
+        self.position = position
+
+
+    def __get__(self, record, cls=None):
+        if record is None:
+            return self
+
+        corpus = record.corpus
+        values = record.values()
+
+        if self.kind in "sj":
+            value = corpus.string(values[self.position], values[self.position + 1])
+
+            if self.kind == "j":
+                return json.loads(value) if value else {}
+
+            return value
+
+        if self.kind == "p":
+            if values[self.position] == NO_PARTICIPANT:
+                return []
+
+            return [ParticipantRecord(corpus, values[self.position])]
+
+        return values[self.position]
+
+
+def record_class(name, fields, record, offset_name):
+    """
+    Builds a record class exposing each field as a lazily decoded attribute
+    """
+    attributes = {"__slots__": (), "STRUCT": record, "OFFSET": offset_name}
+    position = 0
+
+    for field, kind in fields:
+        attributes[field] = Field(kind, position)
+        position += 2 if kind in "sj" else 1
+
+    return type(name, (Record,), attributes)
+
+
+class Record(object):
+    __slots__ = ("corpus", "index")
+
+    def __init__(self, corpus, index):
+        self.corpus = corpus
+        self.index = index
+
+
+    def values(self):
+        offset = getattr(self.corpus, self.OFFSET) + self.index * self.STRUCT.size
+
+        return self.STRUCT.unpack_from(self.corpus.data, offset)
+
+
+class ConversationRecord(record_class("ConversationFields", CONVERSATION_FIELDS, CONVERSATION, "conversations_offset")):
+    __slots__ = ()
+
+    @property
+    def messages(self):
+        return [MessageRecord(self.corpus, self.first_message + i) for i in range(self.message_count)]
+
+
+    def load(self):
+        """
+        Builds the Conversation object of the record, with its messages
+        """
+        conversation = Conversation()
+
+        for name, kind in CONVERSATION_FIELDS:
+            if kind != "m":
+                setattr(conversation, name, getattr(self, name))
+
+        conversation.messages = [message.load() for message in self.messages]
+
+        return conversation
+
+
+class MessageRecord(record_class("MessageFields", MESSAGE_FIELDS, MESSAGE, "messages_offset")):
+    __slots__ = ()
+
+    def load(self):
+        """
+        Builds the Message object of the record, with its participants
+        """
+        message = Message()
+
+        for name, kind in MESSAGE_FIELDS:
+            value = getattr(self, name)
+
+            if kind == "p":
+                value = [participant.load() for participant in value]
+
+            setattr(message, name, value)
+
+        return message
+
+
+class ParticipantRecord(record_class("ParticipantFields", PARTICIPANT_FIELDS, PARTICIPANT, "participants_offset")):
+    __slots__ = ()
+
+    def load(self):
+        participant = Participant()
+
+        for name, kind in PARTICIPANT_FIELDS:
+            setattr(participant, name, getattr(self, name))
+
+        return participant
+
+
+def build_table(ids):
+    """
+    Returns an open addressing hash table of record indexes plus one, 0 marking empty slots
+    """
+    slots = 1
+
+    while slots < 2 * len(ids):
+        slots *= 2
+
+    table = [0] * slots
+
+    for index, record_id in enumerate(ids):
+        slot = id_hash(record_id) & (slots - 1)
+
+        while table[slot]:
+            slot = (slot + 1) & (slots - 1)
+
+        table[slot] = index + 1
+
+    return table
+
+
+def id_hash(record_id):
+    return zlib.crc32(record_id.encode("utf-8")) & 0xffffffff
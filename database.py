@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+:Name:
+    database.py
+
+:Authors:
+    Soufian Salim (soufi@nsal.im)
+"""
+
+import json
+import os
+import sqlite3
+
+from conversations import Conversation, Message, Participant
+from utility import to_int
+
+
+BATCH_SIZE = 1000
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS conversations (rowid INTEGER PRIMARY KEY, id TEXT, subject TEXT, category TEXT, "
+        "views INTEGER, status TEXT, misc TEXT)",
+    "CREATE TABLE IF NOT EXISTS participants (rowid INTEGER PRIMARY KEY, id TEXT, role TEXT, real_name TEXT, "
+        "user_name TEXT, email TEXT, description TEXT, misc TEXT)",
+    "CREATE TABLE IF NOT EXISTS messages (rowid INTEGER PRIMARY KEY, id TEXT, conversation INTEGER, position INTEGER, "
+        "conversation_id TEXT, medium TEXT, private INTEGER, likes INTEGER, views INTEGER, importance TEXT, "
+        "subject TEXT, daytime TEXT, encoding TEXT, MIME TEXT, participant_from INTEGER, participant_to INTEGER, "
+        "body TEXT, misc TEXT)",
+]
+
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS conversations_id ON conversations (id)",
+    "CREATE INDEX IF NOT EXISTS conversations_category ON conversations (category)",
+    "CREATE INDEX IF NOT EXISTS participants_id ON participants (id)",
+    "CREATE INDEX IF NOT EXISTS participants_email ON participants (email)",
+    "CREATE INDEX IF NOT EXISTS messages_id ON messages (id)",
+    "CREATE INDEX IF NOT EXISTS messages_conversation ON messages (conversation, position)",
+    "CREATE INDEX IF NOT EXISTS messages_participant_from ON messages (participant_from)",
+    "CREATE INDEX IF NOT EXISTS messages_medium ON messages (medium)",
+    "CREATE INDEX IF NOT EXISTS messages_daytime ON messages (daytime)",
+]
+
+CONVERSATION_COLUMNS = ["id", "subject", "category", "views", "status", "misc"]
+
+MESSAGE_COLUMNS = ["id", "conversation_id", "medium", "private", "likes", "views", "importance", "subject",
+    "daytime", "encoding", "MIME", "body", "misc"]
+
+PARTICIPANT_COLUMNS = ["id", "role", "real_name", "user_name", "email", "description", "misc"]
+
+
+class DatabaseWriter(object):
+    """
+    Stores conversations, messages and participants in an SQLite database, inserting them by batches
+    of batch_size conversations, each in one transaction
+
+    The database is built in path.part and replaces path once closed, so that a run never adds to
+    the rows of a previous one. The indexes are created once all rows are inserted, which is faster
+    than maintaining them.
+    """
+
+    def __init__(self, path, batch_size=BATCH_SIZE):
+        # leftovers of an interrupted run, including its journal
+        for suffix in (".part", ".part-wal", ".part-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+        self.path = path
+        self.connection = sqlite3.connect(path + ".part")
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=OFF")
+
+        for statement in SCHEMA:
+            self.connection.execute(statement)
+
+        self.batch_size = batch_size
+        self.conversation_rowid = 0
+        self.participant_rowid = 0
+        self.participants = {}
+        self.conversations = []
+        self.messages = []
+        self.new_participants = []
+
+
+    def add(self, conversation):
+        """
+        Queues a conversation, its messages and its participants for the next batch
+        """
+        self.conversation_rowid += 1
+
+        self.conversations.append((self.conversation_rowid, unicode(conversation.id), conversation.subject,
+            conversation.category, to_int(conversation.views), conversation.status, encode_misc(conversation.misc)))
+
+        for position, message in enumerate(conversation.messages):
+            self.messages.append((unicode(message.id), self.conversation_rowid, position, unicode(message.conversation_id),
+                message.medium, message.private in (True, "true"), to_int(message.likes), to_int(message.views),
+                message.importance, message.subject, message.daytime, message.encoding, message.MIME,
+                self.participant_rowid_of(message.participant_from), self.participant_rowid_of(message.participant_to),
+                message.body, encode_misc(message.misc)))
+
+        if len(self.conversations) >= self.batch_size:
+            self.commit()
+
+
+    def participant_rowid_of(self, participants):
+        """
+        Returns the row of the first participant of a list, queuing it on first sight
+        """
+        if not participants:
+            return None
+
+        participant = participants[0]
+
+        # the participants table gets one row per distinct participant, misc aside
+        key = tuple(getattr(participant, column) for column in PARTICIPANT_COLUMNS[:-1])
+
+        if key not in self.participants:
+            self.participant_rowid += 1
+            self.participants[key] = self.participant_rowid
+
+            self.new_participants.append((self.participant_rowid,) + key + (encode_misc(participant.misc),))
+
+        return self.participants[key]
+
+
+    def commit(self):
+        """
+        Inserts the queued rows in one transaction
+        """
+        with self.connection:
+            self.connection.executemany("INSERT INTO conversations VALUES (?, ?, ?, ?, ?, ?, ?)", self.conversations)
+            self.connection.executemany("INSERT INTO participants VALUES (?, ?, ?, ?, ?, ?, ?, ?)", self.new_participants)
+            self.connection.executemany("INSERT INTO messages (id, conversation, position, conversation_id, medium, "
+                "private, likes, views, importance, subject, daytime, encoding, MIME, participant_from, participant_to, "
+                "body, misc) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", self.messages)
+
+        del self.conversations[:]
+        del self.messages[:]
+        del self.new_participants[:]
+
+
+    def close(self):
+        """
+        Inserts the last batch, creates the indexes, closes the database and moves it to its path
+        """
+        self.commit()
+
+        with self.connection:
+            for statement in INDEXES:
+                self.connection.execute(statement)
+
+        self.connection.close()
+
+        os.rename(self.path + ".part", self.path)
+
+
+class Database(object):
+    """
+    Selects conversations from a database written by DatabaseWriter, and rebuilds them
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+
+
+    def select(self, category=None, medium=None, participant=None, start=None, end=None):
+        """
+        Yields the conversations of a category having messages with the given medium, written by
+        a participant (given by id or email address) or dated between start and end included
+        """
+        conditions = []
+        parameters = []
+
+        if category is not None:
+            conditions.append("c.category = ?")
+            parameters.append(category)
+
+        if medium is not None:
+            conditions.append("m.medium = ?")
+            parameters.append(medium)
+
+        if participant is not None:
+            conditions.append("m.participant_from IN (SELECT rowid FROM participants WHERE id = ? OR email = ?)")
+            parameters.extend([participant, participant])
+
+        if start is not None:
+            conditions.append("m.daytime >= ?")
+            parameters.append(start)
+
+        if end is not None:
+            conditions.append("m.daytime <= ?")
+            parameters.append(end)
+
+        query = "SELECT DISTINCT c.rowid FROM conversations c JOIN messages m ON m.conversation = c.rowid"
+
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+
+        rows = self.connection.execute(query + " ORDER BY c.rowid", parameters)
+
+        return self.load([row[0] for row in rows])
+
+
+    def load(self, rowids):
+        """
+        Yields the conversations of the given rows, with their messages and participants
+        """
+        participants = {}
+
+        for rowid in rowids:
+            row = self.connection.execute("SELECT {0} FROM conversations WHERE rowid = ?".format(
+                ", ".join(CONVERSATION_COLUMNS)), (rowid,)).fetchone()
+
+            if row is None:
+                raise KeyError(rowid)
+
+            yield load_conversation(row, self.messages(rowid, participants))
+
+
+    def messages(self, rowid, participants):
+        """
+        Returns the messages of a conversation row, in order, sharing participants through the given dictionary
+        """
+        messages = []
+
+        rows = self.connection.execute("SELECT {0}, participant_from, participant_to FROM messages "
+            "WHERE conversation = ? ORDER BY position".format(", ".join(MESSAGE_COLUMNS)), (rowid,))
+
+        for row in rows:
+            message = load_message(row[:-2])
+
+            message.participant_from = self.participants(row[-2], participants)
+            message.participant_to = self.participants(row[-1], participants)
+
+            messages.append(message)
+
+        return messages
+
+
+    def participants(self, rowid, participants):
+        if rowid is None:
+            return []
+
+        if rowid not in participants:
+            row = self.connection.execute("SELECT {0} FROM participants WHERE rowid = ?".format(
+                ", ".join(PARTICIPANT_COLUMNS)), (rowid,)).fetchone()
+
+            participants[rowid] = load_participant(row)
+
+        return [participants[rowid]]
+
+
+    def close(self):
+        self.connection.close()
+
+
+def load_conversation(row, messages=()):
+    """
+    Builds a conversation from a row of CONVERSATION_COLUMNS
+    """
+    conversation = Conversation()
+
+    for column, value in zip(CONVERSATION_COLUMNS, row):
+        setattr(conversation, column, decode_misc(value) if column == "misc" else value)
+
+    conversation.messages = list(messages)
+
+    return conversation
+
+
+def load_message(row):
+    """
+    Builds a message, without participants, from a row of MESSAGE_COLUMNS
+    """
+    message = Message()
+
+    for column, value in zip(MESSAGE_COLUMNS, row):
+        if column == "misc":
+            value = decode_misc(value)
+        elif column == "private":
+            value = bool(value)
+
+        setattr(message, column, value)
+
+    return message
+
+
+def load_participant(row):
+    """
+    Builds a participant from a row of PARTICIPANT_COLUMNS
+    """
+    participant = Participant()
+
+    for column, value in zip(PARTICIPANT_COLUMNS, row):
+        setattr(participant, column, decode_misc(value) if column == "misc" else value)
+
+    return participant
+
+
+def encode_misc(misc):
+    return json.dumps(misc, sort_keys=True) if misc else None
+
+
+def decode_misc(value):
+    return json.loads(value) if value else {}
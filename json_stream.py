@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+:Name:
+    json_stream.py
+
+:Authors:
+    Soufian Salim (soufi@nsal.im)
+"""
+
+import json
+import re
+
+from compression import open_file, compression_of
+from metrics import measure
+
+
+CHUNK_SIZE = 1 << 16
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+STRUCTURE = re.compile(r"[\"\[\]{}]")
+STRING_END = re.compile(r"[\"\\]")
+
+# bytes that may follow a value inside an array or object
+DELIMITERS = b" \t\n\r,]}"
+
+
+class JSONStream(object):
+    """
+    Incremental reader over a JSON document, decoding one value at a time
+    """
+
+    def __init__(self, stream, chunk_size=CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = b""
+        self.position = 0
+        self.offset = 0
+        self.eof = False
+
+
+    def tell(self):
+        """
+        Returns the absolute offset of the next unread byte
+        """
+        return self.offset + self.position
+
+
+    def seek(self, offset):
+        """
+        Moves the reader to an absolute offset of the underlying stream
+        """
+        if self.offset <= offset <= self.offset + len(self.buffer):
+            self.position = offset - self.offset
+        else:
+            self.stream.seek(offset)
+            self.buffer = b""
+            self.position = 0
+            self.offset = offset
+            self.eof = False
+
+
+    def read_value(self):
+        """
+        Decodes the next JSON value
+
+        >>> import io
+        >>> document = b'[0.0001, 2, -1.5e-3, 1E+10, {"a": [3.25, 4e2, true]}, 10, null]'
+        >>> expected = json.loads(document)
+        >>> all(list(JSONStream(io.BytesIO(b" " * shift + document), chunk_size=size).iter_array()) == expected
+        ...     for shift in range(4) for size in range(1, len(document) + 1))
+        True
+        """
+        char = self.peek()
+
+        while True:
+            try:
+                with measure("json_parse", items=0) as measurement:
+                    value, end = self.decoder.raw_decode(self.buffer, self.position)
+
+                    measurement.items, measurement.size = 1, end - self.position
+            except ValueError:
+                if not self._fill():
+                    raise
+
+                continue
+
+            # a number or literal not followed by a delimiter may be truncated, e.g. "1.5" of "1.5e3"
+            if char in b"{[\"" or (end < len(self.buffer) and self.buffer[end] in DELIMITERS) or not self._fill():
+                self.position = end
+
+                return value
+
+
+    def skip_value(self):
+        """
+        Moves past the next JSON value without building it
+        """
+        if self.peek() not in b"{[\"":
+            self.read_value()
+
+            return
+
+        depth = 0
+        in_string = False
+
+        while True:
+            match = (STRING_END if in_string else STRUCTURE).search(self.buffer, self.position)
+
+            if match is None:
+                self.position = len(self.buffer)
+
+                if not self._fill():
+                    raise ValueError("Unexpected end of JSON data at offset {0}".format(self.tell()))
+
+                continue
+
+            token = match.group()
+            self.position = match.end()
+
+            if in_string:
+                if token == b"\\":
+                    if self.position >= len(self.buffer) and not self._fill():
+                        raise ValueError("Unexpected end of JSON data at offset {0}".format(self.tell()))
+
+                    self.position += 1
+                else:
+                    in_string = False
+
+                    if depth == 0:
+                        return
+            elif token == b"\"":
+                in_string = True
+            elif token in b"{[":
+                depth += 1
+            else:
+                depth -= 1
+
+                if depth == 0:
+                    return
+
+
+    def iter_array(self):
+        """
+        Yields the items of the next JSON array one at a time
+        """
+        return LazyArray(self)
+
+
+    def iter_objects(self, lazy_key, required_keys=(), seekable=True):
+        """
+        Yields the objects of the next JSON array, with the array stored under lazy_key streamed lazily
+
+        Every key in required_keys is decoded before the object is yielded. When such a key follows
+        lazy_key in the document, the nested array is skipped and read again once the object is
+        complete, or decoded in memory if the stream is not seekable (seeking back into a compressed
+        file decompresses it again from its start).
+        """
+        self.expect(b"[")
+
+        if self.peek() == b"]":
+            self.position += 1
+
+            return
+
+        while True:
+            self.expect(b"{")
+
+            item = {}
+            deferred = None
+            buffered = False
+
+            while self.peek() != b"}":
+                key = self.read_value()
+                self.expect(b":")
+
+                if key != lazy_key:
+                    item[key] = self.read_value()
+                elif all(required in item for required in required_keys):
+                    nested = item[key] = LazyArray(self)
+
+                    yield item
+
+                    nested.skip()
+                elif not seekable:
+                    item[key] = self.read_value()
+                    buffered = True
+                else:
+                    deferred = self.tell()
+                    self.skip_value()
+
+                if self.expect(b",}") == b"}":
+                    self.position -= 1
+
+            self.position += 1
+
+            if deferred is not None:
+                resume = self.tell()
+
+                self.seek(deferred)
+
+                nested = item[lazy_key] = LazyArray(self)
+
+                yield item
+
+                nested.skip()
+                self.seek(resume)
+            elif buffered:
+                yield item
+
+            if self.expect(b",]") == b"]":
+                return
+
+
+    def peek(self):
+        """
+        Skips whitespace and returns the next byte without consuming it
+        """
+        while True:
+            self.position = WHITESPACE.match(self.buffer, self.position).end()
+
+            if self.position < len(self.buffer):
+                return self.buffer[self.position:self.position + 1]
+
+            if not self._fill():
+                return b""
+
+
+    def expect(self, chars):
+        """
+        Consumes the next byte, which must be one of chars
+        """
+        char = self.peek()
+
+        if not char or char not in chars:
+            raise ValueError("Expecting one of '{0}' at offset {1}".format(chars, self.tell()))
+
+        self.position += 1
+
+        return char
+
+
+    def _fill(self):
+        """
+        Reads more data into the buffer, dropping what has already been consumed
+        """
+        if self.eof:
+            return False
+
+        if self.position:
+            self.offset += self.position
+            self.buffer = self.buffer[self.position:]
+            self.position = 0
+
+        with measure("read") as measurement:
+            data = self.stream.read(max(self.chunk_size, len(self.buffer)))
+
+            measurement.size = len(data)
+
+        if not data:
+            self.eof = True
+
+            return False
+
+        self.buffer += data
+
+        return True
+
+
+class LazyArray(object):
+    """
+    Iterable over the items of a JSON array that is being read from a JSONStream
+    """
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.started = False
+        self.pending = False
+        self.done = False
+
+
+    def __iter__(self):
+        self._start()
+
+        if self.pending:
+            self.pending = False
+            self._next()
+
+        while not self.done:
+            value = self.reader.read_value()
+
+            self.pending = True
+
+            yield value
+
+            self.pending = False
+            self._next()
+
+
+    def skip(self):
+        """
+        Moves the reader past the items that were not consumed
+        """
+        self._start()
+
+        if self.pending:
+            self.pending = False
+            self._next()
+
+        while not self.done:
+            self.reader.skip_value()
+            self._next()
+
+
+    def _start(self):
+        if not self.started:
+            self.started = True
+            self.reader.expect(b"[")
+
+            if self.reader.peek() == b"]":
+                self.reader.position += 1
+                self.done = True
+
+
+    def _next(self):
+        self.done = self.reader.expect(b",]") == b"]"
+
+
+def iter_json_file(filename, lazy_key=None, required_keys=()):
+    """
+    Yields the items of the top-level array of a JSON file, possibly compressed, one at a time
+    """
+    with open_file(filename) as f:
+        reader = JSONStream(f)
+
+        if lazy_key:
+            items = reader.iter_objects(lazy_key, required_keys, seekable=compression_of(filename) is None)
+        else:
+            items = reader.iter_array()
+
+        for item in items:
+            yield item
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+:Name:
+    metrics.py
+
+:Authors:
+    Soufian Salim (soufi@nsal.im)
+"""
+
+import collections
+import contextlib
+import time
+
+
+STAGES = ["read", "json_parse", "model_build", "serialize", "write", "segment", "validate"]
+
+# named counters of the current run, stage metrics being stored as "stage.wall", "stage.cpu",
+# "stage.items" and "stage.bytes", and gathered from worker processes by utility.convert_files
+counters = collections.Counter()
+
+# stages being measured, innermost last, as [stage, wall start, cpu start, nested wall, nested cpu]
+active = []
+
+cpu_time = time.clock # processor time of the process on Unix
+
+
+def start(stage):
+    """
+    Starts measuring a stage
+    """
+    active.append([stage, time.time(), cpu_time(), 0.0, 0.0])
+
+
+def stop(items=0, size=0):
+    """
+    Stops measuring the innermost stage, adding its time, items and bytes to the counters
+
+    Times are exclusive: the time spent in a nested stage is only counted for the nested stage.
+    """
+    stage, wall_start, cpu_start, nested_wall, nested_cpu = active.pop()
+
+    wall = time.time() - wall_start
+    cpu = cpu_time() - cpu_start
+
+    counters[stage + ".wall"] += wall - nested_wall
+    counters[stage + ".cpu"] += cpu - nested_cpu
+    counters[stage + ".items"] += items
+    counters[stage + ".bytes"] += size
+
+    if active:
+        active[-1][3] += wall
+        active[-1][4] += cpu
+
+
+class Measurement(object):
+    """
+    Items and bytes processed by a measured block, which the block can update
+    """
+    __slots__ = ("items", "size")
+
+    def __init__(self, items, size):
+        self.items = items
+        self.size = size
+
+
+@contextlib.contextmanager
+def measure(stage, items=1, size=0):
+    """
+    Measures a block as a stage processing items items of size bytes, yielding the measurement
+    """
+    measurement = Measurement(items, size)
+
+    start(stage)
+
+    try:
+        yield measurement
+    finally:
+        stop(measurement.items, measurement.size)
+
+
+def measure_iter(stage, iterable):
+    """
+    Yields the items of an iterable, measuring the production of each one as a stage
+    """
+    iterator = iter(iterable)
+
+    while True:
+        start(stage)
+
+        try:
+            item = next(iterator)
+        except StopIteration:
+            stop(0)
+
+            return
+        except Exception:
+            stop(0)
+
+            raise
+
+        stop(1)
+
+        yield item
+
+
+class MeasuredFile(object):
+    """
+    Wraps a file object being written, measuring each write as a stage, e.g. to tell the writes of
+    a document that is streamed to a file from its serialization
+    """
+
+    def __init__(self, f, stage="write"):
+        self.file = f
+        self.stage = stage
+        self.size = 0
+
+
+    def write(self, data):
+        start(self.stage)
+
+        try:
+            self.file.write(data)
+        finally:
+            stop(0, len(data))
+
+        self.size += len(data)
+
+
+def report(wall, cpu, peak):
+    """
+    Returns the metrics of a run: its total wall and CPU times and peak memory, the wall and CPU
+    time, items and bytes of each stage, and the other counters
+    """
+    stages = {}
+    others = {}
+
+    for name, value in counters.items():
+        stage, dot, metric = name.rpartition(".")
+
+        if stage in STAGES and metric in ("wall", "cpu", "items", "bytes"):
+            stages.setdefault(stage, {"wall": 0, "cpu": 0, "items": 0, "bytes": 0})[metric] = value
+        else:
+            others[name] = value
+
+    for metrics in stages.values():
+        metrics["items_per_second"] = metrics["items"] / metrics["wall"] if metrics["wall"] else None
+
+    return {"wall": wall, "cpu": cpu, "peak_memory": peak, "stages": stages, "counters": others}
@@ -9,21 +9,38 @@
     Soufian Salim (soufi@nsal.im)
 """
 
-import codecs
+import cPickle
 import doctest
+import glob
+import hashlib
+import io
 import json
+import json_stream
 import os
-import xml.etree.cElementTree as ET
+import sys
 
+from multiprocessing import Pool
 from optparse import OptionParser
-from progressbar import ProgressBar
-from utility import timed_print, remove_extension, save_to_file
-from conversations import Conversation, Message, Participant
+from json_stream import iter_json_file
+from shards import DEFAULT_SHARD_SIZE, ShardWriter
+from corpus import CorpusWriter
+from database import DatabaseWriter
+from sampling import Sampler
+from metrics import counters, measure, measure_iter, MeasuredFile
+from compression import COMPRESSIONS, DEFAULT_LEVEL, open_file, compressed_filename
+from utility import timed_print, run_script, remove_extension, save_to_file, progress_bar, peak_memory, disable_progress, file_hash
+from xml_validate import load_schema, check_document
+from conversations import Conversation, Message, ParticipantRegistry, key_id
 
 
 QUICK_RUN_MESSAGE_LIMIT = 100
 
-progress = ProgressBar()
+QUICK_RUN_CONVERSATION_LIMIT = 100
+
+XML_DECLARATION = "<?xml version=\"1.0\" encoding=\"UTF-8\"?>"
+
+# bump when the XML produced from an unchanged input file changes, to rewrite everything once
+MANIFEST_VERSION = 1
 
 
 def normalize(opts, args):
@@ -33,142 +50,697 @@ def normalize(opts, args):
 
     output_folder, label = args
 
+    if opts.validate:
+        load_schema() # fails early without lxml, and is compiled once for all the worker processes
+
+    if opts.incremental:
+        if opts.shards or opts.corpus or opts.database:
+            raise ValueError("Incremental runs rewrite single conversations and cannot write shards, a corpus or a database")
+
+        if make_sampler(opts):
+            raise ValueError("Incremental runs keep every conversation of the changed files and cannot sample them")
+
+        return normalize_incremental(opts, args)
+
+    if opts.jobs > 1:
+        return normalize_parallel(opts, args)
+
+    if opts.stream:
+        return normalize_stream(opts, args)
+
     timed_print("Extracting JSON data")
 
-    data = extract_data(opts.email, opts.forum, test=opts.quick)
+    data = extract_data(opts.email, opts.forum, test=opts.quick, sampler=make_sampler(opts))
+
+    timed_print("Exporting {0} conversations to {1}".format(len(data), output_folder))
+
+    output = open_output(opts, output_folder, label)
+
+    for i, conversation in progress_bar(enumerate(data), maxval=len(data)):
+        output.write_conversation(output_name(label, i + 1, opts.compress), conversation)
+
+    output.close()
+
+    sinks = open_sinks(opts)
+
+    if sinks:
+        timed_print("Storing conversations to {0}".format(", ".join(filter(None, [opts.corpus, opts.database]))))
+
+        for conversation in progress_bar(data):
+            for sink in sinks:
+                sink.add(conversation)
+
+        for sink in sinks:
+            sink.close()
+
+
+def normalize_stream(opts, args):
+    """
+    Converts messages to the ODISAE format one conversation at a time, keeping at most
+    opts.window conversations in memory
+    """
+
+    output_folder, label = args
+
+    timed_print("Streaming conversations to {0} (window: {1})".format(output_folder, opts.window))
+
+    output = open_output(opts, output_folder, label)
+    sinks = open_sinks(opts)
+
+    window = []
+    count = 0
+
+    for conversation in iter_data(opts.email, opts.forum, test=opts.quick, sampler=make_sampler(opts)):
+        window.append(conversation)
+
+        if len(window) >= opts.window:
+            count = export_conversations(window, output, label, count, opts.compress, sinks)
+
+            del window[:]
+
+    count = export_conversations(window, output, label, count, opts.compress, sinks)
+
+    output.close()
+
+    for sink in sinks:
+        sink.close()
+
+    timed_print("Exported {0} conversations (peak RSS: {1} MB)".format(count, peak_memory() // 2 ** 20))
+
+
+def normalize_parallel(opts, args):
+    """
+    Converts messages to the ODISAE format, parsing input files in opts.jobs worker processes
+
+    Workers write each file's conversations under temporary names, which are then renamed in
+    input file order so that the numbering matches a serial run. When sampling, each worker
+    samples its own file and the parent applies the overall quotas, stopping the workers once
+    they are met.
+    """
+
+    output_folder, label = args
+
+    input_files = list_input_files(opts.email, opts.forum)
+
+    timed_print("Converting {0} files with {1} processes".format(len(input_files), opts.jobs))
+
+    tasks = [(medium, filename, output_folder, label, number, opts.quick, make_sampler(opts), opts.compress,
+        opts.compression_level, bool(opts.corpus or opts.database), opts.validate) for number, (medium, filename) in enumerate(input_files)]
+
+    pool = Pool(opts.jobs, initializer=disable_progress)
+
+    output = open_output(opts, output_folder, label)
+    sinks = open_sinks(opts)
+    sampler = make_sampler(opts)
+
+    count = 0
+
+    results = pool.imap(normalize_file, tasks)
+
+    for number, (categories, run_counters) in enumerate(progress_bar(results, maxval=len(tasks))):
+        counters.update(run_counters)
+
+        accepted = [sampler is None or sampler.accept(category) for category in categories]
+
+        for i, accept in enumerate(accepted):
+            if accept:
+                count += 1
+
+                output.move(partial_filename(output_folder, label, number, i + 1, opts.compress),
+                    output_name(label, count, opts.compress))
+            else:
+                os.remove(partial_filename(output_folder, label, number, i + 1, opts.compress))
+
+        if sinks:
+            with open(pickle_filename(output_folder, label, number), "rb") as f:
+                for accept in accepted:
+                    conversation = cPickle.load(f)
+
+                    if accept:
+                        for sink in sinks:
+                            sink.add(conversation)
+
+            os.remove(pickle_filename(output_folder, label, number))
+
+        if sampler and sampler.full():
+            break
+
+    if sampler and sampler.full():
+        pool.terminate()
+        pool.join()
+
+        # files of the input files parsed past the quota
+        for filepath in glob.glob("{0}.{1}_*.part*".format(output_folder, label)):
+            os.remove(filepath)
+    else:
+        pool.close()
+        pool.join()
+
+    output.close()
+
+    for sink in sinks:
+        sink.close()
+
+    timed_print("Exported {0} conversations".format(count))
+
+
+def normalize_incremental(opts, args):
+    """
+    Converts messages to the ODISAE format, skipping the input files whose hash is recorded in the
+    output folder's manifest and rewriting only the conversations that changed in the others
+
+    A conversation keeps its output file for as long as its id, derived from its first message,
+    stays the same. New conversations are numbered after the highest number ever used.
+    """
+
+    output_folder, label = args
+
+    manifest_path = manifest_filename(output_folder, label)
+    manifest = load_manifest(manifest_path)
 
-    timed_print("Converting {0} conversations to XML".format(len(data)))
+    settings = {"version": MANIFEST_VERSION, "quick": opts.quick, "compress": opts.compress}
+    outdated = manifest["settings"] != settings
 
-    xmls = []
+    input_files = list_input_files(opts.email, opts.forum)
 
-    for conversation in progress([conversation.xml_serialize() for conversation in data]):
-        xml = "<?xml version=\"1.0\" encoding=\"UTF-8\"?>"
-        xml += ET.tostring(conversation)
+    inputs = {}
+    skipped = written = unchanged = removed = 0
 
-        xmls.append(xml)
+    for medium, filename in input_files:
+        key = os.path.normpath(filename)
+        digest = file_hash(filename)
+        previous = manifest["inputs"].pop(key, None)
 
-    timed_print("Exporting to {0}".format(output_folder))
+        if previous and previous["hash"] == digest and not outdated:
+            inputs[key] = previous
+            skipped += 1
 
-    for i, xml in progress(enumerate(xmls)):
-        save_to_file(xml, "{0}{1}_{2}.xml".format(output_folder, label, i + 1))
+            continue
 
+        outputs = dict((entry[0], entry[1:]) for entry in previous["conversations"]) if previous else {}
+        conversations = []
 
-def extract_data(email_folder, forum_folder, test=False):
+        for conversation in parse_input_file(medium, filename, test=opts.quick):
+            xml = conversation_xml(conversation, opts.validate)
+
+            xml_hash = hashlib.sha1(xml).hexdigest()
+
+            if conversation.id in outputs:
+                name, previous_hash = outputs.pop(conversation.id)
+
+                # the output keeps its number when the compression changes
+                if compressed_filename(name, opts.compress) != name:
+                    removed += remove_outputs(output_folder, [(name, previous_hash)])
+                    name, previous_hash = compressed_filename(name, opts.compress), None
+            else:
+                manifest["next"] += 1
+                name, previous_hash = output_name(label, manifest["next"], opts.compress), None
+
+            if xml_hash == previous_hash and os.path.exists(output_folder + name):
+                unchanged += 1
+            else:
+                save_to_file(xml, output_folder + name, opts.compression_level)
+                written += 1
+
+            conversations.append([conversation.id, name, xml_hash])
+
+        removed += remove_outputs(output_folder, outputs.values())
+
+        inputs[key] = {"hash": digest, "conversations": conversations}
+
+    # input files that disappeared take their conversations with them
+    for previous in manifest["inputs"].values():
+        removed += remove_outputs(output_folder, [entry[1:] for entry in previous["conversations"]])
+
+    manifest["settings"] = settings
+    manifest["inputs"] = inputs
+
+    save_manifest(manifest, manifest_path)
+
+    timed_print("Skipped {0} unchanged files, wrote {1} conversations ({2} unchanged, {3} removed)".format(
+        skipped, written, unchanged, removed))
+
+
+def normalize_file(task):
+    """
+    Converts the conversations of one input file to temporarily named XML files, and returns their
+    categories and the counters of the run
+
+    With keep, the conversations are also pickled for the parent process to pass them to the sinks.
+    """
+
+    medium, filename, output_folder, label, number, test, sampler, compression, level, keep, validate = task
+
+    categories = []
+
+    pickles = open(pickle_filename(output_folder, label, number), "wb") if keep else None
+
+    for conversation in parse_input_file(medium, filename, test=test, sampler=sampler):
+        categories.append(conversation.category)
+
+        save_conversation(conversation, partial_filename(output_folder, label, number, len(categories), compression),
+            level, validate)
+
+        if pickles:
+            cPickle.dump(conversation, pickles, cPickle.HIGHEST_PROTOCOL)
+
+    if pickles:
+        pickles.close()
+
+    run_counters = dict(counters)
+    counters.clear()
+
+    return categories, run_counters
+
+
+def conversation_xml(conversation, validate=False):
+    """
+    Returns the XML document of a conversation, reporting it right away if validate is set and it
+    does not match the schema
+    """
+    with measure("serialize") as measurement:
+        f = io.BytesIO()
+        f.write(XML_DECLARATION)
+
+        conversation.xml_write(f)
+
+        xml = f.getvalue()
+        measurement.size = len(xml)
+
+    if validate:
+        check_document("Conversation {0}".format(conversation.id), xml)
+
+    return xml
+
+
+def save_conversation(conversation, filepath, level=DEFAULT_LEVEL, validate=False):
+    """
+    Writes the XML document of a conversation to a file, compressed according to its name, as it
+    is serialized (or once serialized and validated, with validate)
+    """
+    if validate:
+        save_to_file(conversation_xml(conversation, validate), filepath, level)
+
+        return
+
+    # opening and closing the file, which flushes the compressor, are part of the write stage
+    with measure("write"), open_file(filepath, "wb", level) as f:
+        output = MeasuredFile(f, "write")
+
+        with measure("serialize") as measurement:
+            output.write(XML_DECLARATION)
+
+            conversation.xml_write(output)
+
+            measurement.size = output.size
+
+
+def export_conversations(conversations, output, label, count, compression=None, sinks=()):
+    """
+    Serializes and saves conversations numbered after the count already exported, and returns the new count
+    """
+
+    for conversation in conversations:
+        count += 1
+
+        output.write_conversation(output_name(label, count, compression), conversation)
+
+        for sink in sinks:
+            sink.add(conversation)
+
+    return count
+
+
+class FileOutput(object):
+    """
+    Writes each conversation to its own file in the output folder, compressed according to its name
+    """
+
+    def __init__(self, output_folder, level=DEFAULT_LEVEL, validate=False):
+        self.output_folder = output_folder
+        self.level = level
+        self.validate = validate
+
+
+    def write(self, name, xml):
+        save_to_file(xml, self.output_folder + name, self.level)
+
+
+    def write_conversation(self, name, conversation):
+        save_conversation(conversation, self.output_folder + name, self.level, self.validate)
+
+
+    def move(self, filepath, name):
+        os.rename(filepath, self.output_folder + name)
+
+
+    def close(self):
+        pass
+
+
+class ShardOutput(ShardWriter):
+    """
+    Writes conversations to shards, each document being built in memory to know its length
+    """
+
+    def __init__(self, output_folder, label, max_size=DEFAULT_SHARD_SIZE * 2 ** 20, validate=False):
+        ShardWriter.__init__(self, output_folder, label, max_size)
+
+        self.validate = validate
+
+
+    def write_conversation(self, name, conversation):
+        self.write(name, conversation_xml(conversation, self.validate))
+
+
+def open_output(opts, output_folder, label):
+    """
+    Returns where to write conversations: one file each, or size-bounded shards with --shards
+    """
+
+    if opts.shards:
+        if opts.compress:
+            raise ValueError("Shards are read at random offsets and cannot be compressed")
+
+        return ShardOutput(output_folder, label, max_size=opts.shard_size * 2 ** 20, validate=opts.validate)
+
+    return FileOutput(output_folder, opts.compression_level, opts.validate)
+
+
+def pickle_filename(output_folder, label, number):
+    """
+    Returns the temporary path of the conversations pickled by a worker
+    """
+
+    return "{0}.{1}_{2}.pickle.part".format(output_folder, label, number)
+
+
+def open_sinks(opts):
+    """
+    Returns the writers receiving every conversation besides the XML output: the packed corpus and
+    the SQLite database
+    """
+
+    sinks = []
+
+    if opts.corpus:
+        sinks.append(CorpusWriter(opts.corpus))
+
+    if opts.database:
+        sinks.append(DatabaseWriter(opts.database))
+
+    return sinks
+
+
+def output_name(label, number, compression=None):
+    """
+    Returns the name of the numbered XML output file
+    """
+
+    return compressed_filename("{0}_{1}.xml".format(label, number), compression)
+
+
+def partial_filename(output_folder, label, number, index, compression=None):
+    """
+    Returns the temporary path of a conversation parsed by a worker, before it is numbered
+    """
+
+    return compressed_filename("{0}.{1}_{2}_{3}.xml.part".format(output_folder, label, number, index), compression)
+
+
+def manifest_filename(output_folder, label):
+    """
+    Returns the path of the manifest of incremental runs
+    """
+
+    return "{0}{1}.manifest.json".format(output_folder, label)
+
+
+def load_manifest(path):
+    """
+    Reads the manifest of the previous incremental run, mapping each input file to its hash and to
+    the id, output file name and XML hash of its conversations
+    """
+    if not os.path.exists(path):
+        return {"settings": None, "next": 0, "inputs": {}}
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, path):
+    """
+    Writes the manifest, replacing the previous one only once it is complete
+    """
+    with open(path + ".part", "w") as f:
+        json.dump(manifest, f, sort_keys=True)
+
+    os.rename(path + ".part", path)
+
+
+def remove_outputs(output_folder, outputs):
+    """
+    Deletes the output files of conversations that no longer exist, and returns their number
+    """
+    removed = 0
+
+    for name, xml_hash in outputs:
+        if os.path.exists(output_folder + name):
+            os.remove(output_folder + name)
+
+        removed += 1
+
+    return removed
+
+
+def assign_ids(conversation, taken):
+    """
+    Gives a conversation and its messages ids derived from their content, so that they are the same
+    on every run: the conversation's from its first message, which does not change as replies are
+    added, and each message's from its own content and position
+
+    taken holds the conversation ids already given for the same input file.
+    """
+    first = conversation.messages[0] if conversation.messages else Message()
+    author = first.participant_from[0].id if first.participant_from else None
+
+    key = u"\0".join(unicode(part) for part in (first.medium, conversation.category, conversation.subject, first.daytime, author))
+    conversation_id = key_id(key)
+
+    collisions = 1
+
+    while conversation_id in taken:
+        collisions += 1
+        conversation_id = key_id(u"{0}\0{1}".format(key, collisions))
+
+    taken.add(conversation_id)
+
+    conversation.id = conversation_id
+
+    for position, message in enumerate(conversation.messages):
+        author = message.participant_from[0].id if message.participant_from else None
+
+        message.id = key_id(u"\0".join(unicode(part) for part in (conversation_id, position, message.daytime, author, message.body)))
+
+        if message.conversation_id is not None:
+            message.conversation_id = conversation_id
+
+
+def extract_data(email_folder, forum_folder, test=False, sampler=None):
     """
     Extracts data from email and forum JSON files
     """
-    data = []
+    return list(iter_data(email_folder, forum_folder, test=test, sampler=sampler))
+
+
+def iter_data(email_folder, forum_folder, test=False, sampler=None):
+    """
+    Yields conversations from email and forum JSON files as they are parsed, or a sample of them,
+    the next files not being read once the sample is complete
+    """
+    for medium, filename in list_input_files(email_folder, forum_folder):
+        if sampler and sampler.full():
+            break
+
+        for conversation in parse_input_file(medium, filename, test=test, sampler=sampler):
+            yield conversation
+
+
+def list_input_files(email_folder, forum_folder):
+    """
+    Lists the (medium, filename) pairs of the JSON files to parse, in processing order
+    """
+    input_files = []
 
     if email_folder:
         email_files = os.listdir(email_folder)
 
         timed_print("Parsing {0} email files from {1}...".format(len(email_files), email_folder))
 
-        for filename in  email_files:
-            json_data = parse_json_file("{0}/{1}".format(email_folder, filename))
-            data.extend(parse_email_data(json_data, category=remove_extension(filename), test=test))
+        input_files.extend(("email", "{0}/{1}".format(email_folder, filename)) for filename in email_files)
 
     if forum_folder:
         forum_files = os.listdir(forum_folder)
 
         timed_print("Parsing {0} forum files from {1}...".format(len(forum_files), forum_folder))
 
-        for filename in  forum_files:
-            json_data = parse_json_file("{0}/{1}".format(forum_folder, filename))
-            data.extend(parse_forum_data(json_data, test=test))
+        input_files.extend(("forum", "{0}/{1}".format(forum_folder, filename)) for filename in forum_files)
+
+    return input_files
+
+
+def parse_input_file(medium, filename, test=False, sampler=None):
+    """
+    Yields the conversations of an email or forum JSON file, or the sample of them drawn by sampler
+
+    Participants are interned per file (see ParticipantRegistry), so that their names do not depend on
+    the files parsed before.
+    """
+    participants = ParticipantRegistry()
+
+    if medium == "email":
+        # all the conversations of an email file have its category
+        category = remove_extension(os.path.basename(filename))
+
+        json_data = iter_json_file(filename)
+        conversations = parse_email_data(json_data, category=category, test=test, participants=participants)
+    else:
+        category = None
+
+        json_data = iter_json_file(filename, lazy_key="threads", required_keys=("description",))
+        conversations = parse_forum_data(json_data, test=test, participants=participants,
+            full=sampler.full if sampler else None)
+
+    conversations = measure_iter("model_build", conversations)
 
-    return data
+    if sampler is None:
+        return conversations
+
+    return sampler.sample(conversations, "{0}/{1}".format(medium, os.path.basename(filename)), category)
+
+
+def make_sampler(opts):
+    """
+    Returns the sampler of the run, or None when every conversation is kept
+
+    --quick stands for --limit=100, conversations being cut at 100 messages.
+    """
+    limit = opts.limit
+
+    if opts.quick and limit is None:
+        limit = QUICK_RUN_CONVERSATION_LIMIT
+
+    if limit is None and opts.sample_rate == 1:
+        return None
+
+    return Sampler(limit, opts.sample_rate, opts.seed, opts.stratify)
 
 
 def parse_json_file(filename):
     """
-    Reads a JSON file
+    Reads a JSON file, possibly compressed, at once (see json_stream.iter_json_file for large files)
     """
-    file_data = codecs.open(filename, encoding="utf-8").read()
+    with measure("read") as measurement, open_file(filename) as f:
+        file_data = f.read()
+
+        measurement.size = len(file_data)
 
-    return json.loads(file_data)
+    with measure("json_parse", size=len(file_data)):
+        return json.loads(file_data.decode("utf-8"))
 
 
-def parse_email_data(data, category=None, test=False):
+def parse_email_data(data, category=None, test=False, participants=None):
     """
-    Parses JSON email data
+    Parses JSON email data, yielding one conversation per initial email
     """
-    conversations = []
+    if participants is None:
+        participants = ParticipantRegistry()
 
-    for initial_email in progress(data):
+    taken = set()
+
+    for initial_email in progress_bar(data):
         conversation = Conversation()
         conversation.subject = initial_email["subject"]
         conversation.category = category
         
-        for message in parse_email_tree(initial_email, conversation.id):
+        for message in parse_email_tree(initial_email, conversation.id, test=test, participants=participants):
             conversation.messages.append(message)
 
-        conversations.append(conversation)
+        assign_ids(conversation, taken)
 
-    return conversations
+        yield conversation
 
 
-def parse_email_tree(item, conversation_id, to=None, test=False):
+def parse_email_tree(item, conversation_id, to=None, test=False, participants=None):
     """
-    Recursively parses an email message
+    Parses an email message and its answers, yielding each message before its answers
+
+    Answers are walked with an explicit stack rather than by recursion, so that deep threads
+    take linear time and cannot reach the recursion limit. In test mode, at most
+    QUICK_RUN_MESSAGE_LIMIT messages are yielded.
     """
+    if participants is None:
+        participants = ParticipantRegistry()
 
-    message = Message()   
-    message.medium = "email"
-    message.conversation_id = conversation_id
-    message.subject = item["subject"]
-    message.daytime = item["datetime"]
-    message.encoding = "UTF-8"
-    message.MIME = "text/plain"
-    message.body = item["content"]
+    stack = [(item, to)]
+    message_number = 0
 
-    participant = Participant()
-    participant.real_name = item["author_name"]
-    participant.email = item["author_address"]
+    while stack:
+        if test and message_number >= QUICK_RUN_MESSAGE_LIMIT:
+            break
 
-    message.participant_from.append(participant)
+        item, to = stack.pop()
 
-    if to:
-        message.participant_to.append(to)
+        message = Message()
+        message.medium = "email"
+        message.conversation_id = conversation_id
+        message.subject = item["subject"]
+        message.daytime = item["datetime"]
+        message.encoding = "UTF-8"
+        message.MIME = "text/plain"
+        message.body = item["content"]
 
-    messages = [message]
+        participant = participants.email(item["author_address"], item["author_name"])
 
-    if "answers" in item:
-        for answer in item["answers"]:
-            messages.extend(parse_email_tree(answer, conversation_id, to=participant))
+        message.participant_from.append(participant)
 
-            if test and len(messages) >= QUICK_RUN_MESSAGE_LIMIT:
-                break
+        if to:
+            message.participant_to.append(to)
 
-    return messages
+        yield message
 
+        message_number += 1
 
-def parse_forum_data(data, test=False):
-    """
-    Parses JSON forum data
+        # pushed in reverse so that the first answer is parsed next
+        stack.extend((answer, participant) for answer in reversed(item.get("answers", ())))
+
+
+def parse_forum_data(data, test=False, participants=None, full=None):
     """
-    message_number = 0
+    Parses JSON forum data, yielding one conversation per thread
 
-    conversations = []
+    In test mode, threads are cut at QUICK_RUN_MESSAGE_LIMIT messages. The remaining threads of a
+    forum are skipped without being decoded once full(category) tells that no more conversations of
+    its category are wanted.
+    """
+    if participants is None:
+        participants = ParticipantRegistry()
 
-    progress = ProgressBar()
+    taken = set()
 
-    for forum in progress(data):
-        if test and message_number >= QUICK_RUN_MESSAGE_LIMIT:
-            continue;
+    for forum in progress_bar(data):
+        if full is not None and full(forum["description"]):
+            continue
 
         for thread in forum["threads"]:
-            if test and message_number >= QUICK_RUN_MESSAGE_LIMIT:
-                break;
-
             conversation = Conversation()
             conversation.subject = thread["name"]
             conversation.category = forum["description"]
             conversation.status = "closed" if thread["closed"] else "open"
 
-            for post in thread["posts"]:
+            for message_number, post in enumerate(thread["posts"]):
                 if test and message_number >= QUICK_RUN_MESSAGE_LIMIT:
-                    break;
+                    break
 
                 message = Message()
                 message.medium = "forum"
@@ -181,19 +753,18 @@ def parse_forum_data(data, test=False):
                 if post["signature"]:
                     message.misc["signature"] = post["signature"]
 
-                participant = Participant()
-                participant.user_name = post["author"]
-                participant.description = str(post["author_id"])
+                participant = participants.forum(post["author_id"], post["author"])
 
                 message.participant_from.append(participant)
 
                 conversation.messages.append(message)
 
-                message_number += 1
+            assign_ids(conversation, taken)
 
-            conversations.append(conversation)
+            yield conversation
 
-    return conversations
+            if full is not None and full(forum["description"]):
+                break
 
 
 def parse_args():
@@ -215,7 +786,98 @@ def parse_args():
         dest="quick",
         default=False,
         action="store_true",
-        help="quick run for testing purposes (stops around 100 messages of each type)")
+        help="quick run for testing purposes, same as --limit=100 with conversations cut at 100 messages")
+
+    op.add_option("--limit",
+        dest="limit",
+        default=None,
+        type="int",
+        help="stops after this many conversations, or this many of each category with --stratify")
+
+    op.add_option("--sample-rate",
+        dest="sample_rate",
+        default=1.0,
+        type="float",
+        help="keeps each conversation with this probability (default: 1)")
+
+    op.add_option("--seed",
+        dest="seed",
+        default=0,
+        type="int",
+        help="seed of the sample drawn with --sample-rate (default: 0)")
+
+    op.add_option("--stratify",
+        dest="stratify",
+        default=False,
+        action="store_true",
+        help="applies --limit to each category")
+
+    op.add_option("--stream",
+        dest="stream",
+        default=False,
+        action="store_true",
+        help="writes each conversation as soon as it is parsed instead of loading the whole corpus")
+
+    op.add_option("--window",
+        dest="window",
+        default=1,
+        type="int",
+        help="number of conversations held in memory before being written in stream mode (default: 1)")
+
+    op.add_option("--jobs",
+        dest="jobs",
+        default=1,
+        type="int",
+        help="number of processes parsing input files in parallel (default: 1)")
+
+    op.add_option("--shards",
+        dest="shards",
+        default=False,
+        action="store_true",
+        help="packs conversations into shard files with an offset table instead of one file each")
+
+    op.add_option("--shard-size",
+        dest="shard_size",
+        default=DEFAULT_SHARD_SIZE,
+        type="int",
+        help="maximum size of a shard in MB (default: {0})".format(DEFAULT_SHARD_SIZE))
+
+    op.add_option("--compress",
+        dest="compress",
+        default=None,
+        type="choice",
+        choices=COMPRESSIONS,
+        help="compresses the XML files: gz, bz2 or xz")
+
+    op.add_option("--compression-level",
+        dest="compression_level",
+        default=DEFAULT_LEVEL,
+        type="int",
+        help="compression level, from 1 (fastest) to 9 (smallest) (default: {0})".format(DEFAULT_LEVEL))
+
+    op.add_option("--corpus",
+        dest="corpus",
+        default=None,
+        type="string",
+        help="also packs the conversations into a binary corpus file with random access by id")
+
+    op.add_option("--database",
+        dest="database",
+        default=None,
+        type="string",
+        help="also stores the conversations in an SQLite database indexed by participant, category, medium and date")
+
+    op.add_option("--incremental",
+        dest="incremental",
+        default=False,
+        action="store_true",
+        help="only converts the input files changed since the last incremental run into output_folder")
+
+    op.add_option("--validate",
+        dest="validate",
+        default=False,
+        action="store_true",
+        help="validates each conversation against conversation.xsd as it is serialized, reporting the invalid ones (requires lxml)")
 
     op.add_option("--email",
         dest="email",
@@ -231,6 +893,18 @@ def parse_args():
 
     ########################################
 
+    op.add_option("--metrics-json",
+        dest="metrics_json",
+        default=None,
+        type="string",
+        help="writes the wall and CPU time, items and bytes of each stage of the run to this JSON file")
+
+    op.add_option("--profile",
+        dest="profile",
+        default=None,
+        type="string",
+        help="profiles the run with cProfile to PROFILE.prof, and with tracemalloc to PROFILE.tracemalloc when available")
+
     return op.parse_args()
 
 
@@ -246,5 +920,11 @@ if __name__ == "__main__":
 
     if options.test:
         doctest.testmod() # unit testing
+        doctest.testmod(json_stream)
     else:
-        normalize(options, arguments)
\ No newline at end of file
+        run_script(normalize, options, arguments)
+
+        if counters["invalid_documents"]:
+            timed_print("{0} conversations do not match the schema".format(counters["invalid_documents"]))
+
+            sys.exit(1) # for builds to fail on invalid output
\ No newline at end of file
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+:Name:
+    sampling.py
+
+:Authors:
+    Soufian Salim (soufi@nsal.im)
+"""
+
+import collections
+import hashlib
+
+
+class Sampler(object):
+    """
+    Selects the conversations of a development run: each conversation is kept with probability
+    rate, up to limit conversations overall or, with stratify, per category
+
+    Each draw is a hash of the seed, the input file and the conversation id, so that a conversation
+    is drawn the same way whichever conversations are read or skipped before it, and in which process.
+    """
+
+    def __init__(self, limit=None, rate=1.0, seed=0, stratify=False):
+        if not 0 < rate <= 1:
+            raise ValueError("The sample rate must be in ]0, 1]: {0}".format(rate))
+
+        self.limit = limit
+        self.rate = rate
+        self.seed = seed
+        self.stratify = stratify
+        self.counts = collections.Counter()
+
+
+    def sample(self, conversations, key, category=None):
+        """
+        Yields the sampled conversations of an input file, key naming the file, and stops reading
+        it once its quota is met
+
+        category is the category of all the conversations of the file, when known beforehand.
+        """
+        for conversation in conversations:
+            if self.full() or (category is not None and self.full(category)):
+                break
+
+            if self.rate < 1 and self.draw(key, conversation.id) >= self.rate:
+                continue
+
+            if self.accept(conversation.category):
+                yield conversation
+
+
+    def draw(self, key, conversation_id):
+        """
+        Returns a number in [0, 1[ drawn for a conversation of the file named by key
+        """
+        digest = hashlib.sha1("{0}\0{1}\0{2}".format(self.seed, key, conversation_id)).hexdigest()
+
+        return int(digest[:15], 16) / float(16 ** 15)
+
+
+    def accept(self, category):
+        """
+        Counts a conversation of a category in the sample, unless its quota is already met
+        """
+        stratum = category if self.stratify else None
+
+        if self.limit is not None and self.counts[stratum] >= self.limit:
+            return False
+
+        self.counts[stratum] += 1
+
+        return True
+
+
+    def full(self, category=None):
+        """
+        Tells whether no more conversations can be sampled, or no more of a category
+        """
+        if self.limit is None or (self.stratify and category is None):
+            return False
+
+        return self.counts[category if self.stratify else None] >= self.limit
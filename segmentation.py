@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+:Name:
+    segmentation.py
+
+:Authors:
+    Soufian Salim (soufi@nsal.im)
+"""
+
+import copy
+import re
+
+import segmentation_cache
+
+from metrics import measure
+
+
+PUNKT_MODEL = "tokenizers/punkt/french.pickle"
+
+# bump when the rules applied before punkt change, to invalidate cached segmentations
+SEGMENTATION_VERSION = 1
+
+# lines this short end a sentence line, longer ones are wrapped and joined with the next
+LINE_WIDTH = 65
+
+LINE_BREAK = re.compile(u"(<br>|</p>)")
+
+# entries kept by each in-process memo before it is emptied
+MEMO_SIZE = 2 ** 16
+
+tokenizer = None
+
+batch_tokenizer = None
+
+sentence_end = None
+
+period_context = None
+
+token_period_context = None
+
+# punkt decisions by candidate context ("word. Next"), and sentences by joined line
+sentence_breaks = {}
+
+line_sentences = {}
+
+
+def load_tokenizer():
+    """
+    Loads the French punkt model once per process, when a message first needs segmenting
+    """
+    global tokenizer, batch_tokenizer, sentence_end, period_context, token_period_context
+
+    if tokenizer is None:
+        import nltk.data # slow to import, and not needed when every segmentation is cached
+
+        tokenizer = nltk.data.load(PUNKT_MODEL)
+
+        # punkt decides each candidate break from its context alone, which recurs across lines
+        batch_tokenizer = copy.copy(tokenizer)
+        batch_tokenizer.text_contains_sentbreak = contains_sentence_break
+        batch_tokenizer._slices_from_text = slices_from_text
+
+        period_context = tokenizer._lang_vars.period_context_re()
+        token_period_context = re.compile(u"(?<!\\S)" + period_context.pattern, period_context.flags)
+
+        end_chars = u"".join(tokenizer._lang_vars.sent_end_chars)
+        sentence_end = re.compile(u"[{0}]".format(re.escape(end_chars)))
+
+    return tokenizer
+
+
+def contains_sentence_break(context):
+    """
+    Memoised punkt decision of whether a candidate context contains a sentence break
+    """
+    decision = sentence_breaks.get(context)
+
+    if decision is None:
+        if len(sentence_breaks) >= MEMO_SIZE:
+            sentence_breaks.clear()
+
+        decision = sentence_breaks[context] = tokenizer.text_contains_sentbreak(context)
+
+    return decision
+
+
+def slices_from_text(text):
+    """
+    Yields the slices of the sentences of a line like punkt's _slices_from_text, finding the same
+    candidate breaks in linear time
+
+    punkt's pattern starts with \\S*, so finditer tries it again from every character of a word
+    that has no candidate. Only the first try after a match can start inside a word: when it fails,
+    no later start in that word can match either, so the search resumes at the next word.
+    """
+    last_break = 0
+    position = 0
+
+    while True:
+        match = period_context.match(text, position) or token_period_context.search(text, position)
+
+        if match is None:
+            break
+
+        position = match.end()
+
+        if contains_sentence_break(match.group() + match.group("after_tok")):
+            yield slice(last_break, match.end())
+
+            if match.group("next_tok"):
+                # next sentence starts after whitespace
+                last_break = match.start("next_tok")
+            else:
+                # next sentence starts at following punctuation
+                last_break = match.end()
+
+    # the last sentence does not contain trailing whitespace
+    yield slice(last_break, len(text.rstrip()))
+
+
+def clear_memos():
+    """
+    Empties the in-process memos of punkt decisions and line segmentations
+    """
+    sentence_breaks.clear()
+    line_sentences.clear()
+
+
+def init_worker(cache_path=None, cache_size=segmentation_cache.DEFAULT_CACHE_SIZE):
+    """
+    Prepares a converting process by opening the segmentation cache, the tokenizer being
+    loaded on first use
+    """
+    if cache_path:
+        segmentation_cache.open_cache(cache_path, cache_size * 2 ** 20)
+
+
+def segment(text):
+    """
+    Returns the sentences of a message body
+    """
+    return segment_batch([text])[0]
+
+
+def segment_messages(conversation):
+    """
+    Returns the sentences of every message of a conversation
+    """
+    return segment_batch([message.body for message in conversation.messages])
+
+
+def segment_batch(texts):
+    """
+    Returns the sentences of several message bodies, tokenizing each distinct line once
+
+    Segmentations found in the open segmentation cache are reused, and new ones are stored. Lines
+    and punkt's decisions on candidate breaks are also memoised in the process, across batches.
+    """
+    with measure("segment", items=len(texts)):
+        cache = segmentation_cache.cache
+
+        results = [None] * len(texts)
+        pending = []
+
+        for i, text in enumerate(texts):
+            if not text:
+                results[i] = []
+            elif cache is not None:
+                results[i] = cache.get(text)
+
+            if results[i] is None:
+                pending.append(i)
+
+        if not pending:
+            return results
+
+        body_lines = [join_lines(texts[i]) for i in pending]
+
+        load_tokenizer()
+
+        tokenize = batch_tokenizer.tokenize
+        sentences = {}
+
+        for lines in body_lines:
+            for line in lines:
+                if line in sentences:
+                    continue
+
+                found = line_sentences.get(line)
+
+                if found is None:
+                    # punkt only splits at sentence-ending characters and at most trims trailing spaces
+                    if line[-1].isspace() or sentence_end.search(line):
+                        found = tokenize(line)
+                    else:
+                        found = [line]
+
+                    if len(line_sentences) >= MEMO_SIZE:
+                        line_sentences.clear()
+
+                    line_sentences[line] = found
+
+                sentences[line] = found
+
+        for i, lines in zip(pending, body_lines):
+            results[i] = [sentence for line in lines for sentence in sentences[line]]
+
+            if cache is not None:
+                cache.put(texts[i], results[i])
+
+        return results
+
+
+def join_lines(text):
+    """
+    Returns the lines of a message body to tokenize, without quotes and signature, and with
+    wrapped lines joined
+    """
+    parts = []
+
+    for line in text.split(u"\n"):
+        line = line.strip()
+
+        if not line or line[0] == u">":
+            continue
+
+        if line.startswith(u"--"):
+            break
+
+        if u"<" in line:
+            line = LINE_BREAK.sub(u"\\1\n", line)
+
+        parts.append(line)
+        parts.append(u"\n" if len(line) < LINE_WIDTH else u" ")
+
+    return [joined for joined in u"".join(parts).split(u"\n") if joined.strip()]
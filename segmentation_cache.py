@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+:Name:
+    segmentation_cache.py
+
+:Authors:
+    Soufian Salim (soufi@nsal.im)
+"""
+
+import hashlib
+import imp
+import json
+import os
+import sqlite3
+import time
+
+from multiprocessing.util import Finalize
+from utility import timed_print, count, counters
+
+
+DEFAULT_CACHE_SIZE = 512
+
+COMMIT_INTERVAL = 500
+
+cache = None
+
+
+class SegmentationCache(object):
+    """
+    On-disk store of message segmentations, keyed by a hash of the body and the tokenizer version
+    """
+
+    def __init__(self, path, max_size=DEFAULT_CACHE_SIZE * 2 ** 20, version=None):
+        self.path = path
+        self.max_size = max_size
+        self.version = version if version is not None else tokenizer_version()
+        self.connection = sqlite3.connect(path, timeout=300)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=OFF")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS segments (key TEXT PRIMARY KEY, sentences TEXT, size INTEGER, used INTEGER)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS segments_used ON segments (used)")
+        self.connection.commit()
+        self.inserted = []
+        self.used = []
+
+
+    def key(self, text):
+        return hashlib.sha1(u"{0}\0{1}".format(self.version, text).encode("utf-8")).hexdigest()
+
+
+    def get(self, text):
+        """
+        Returns the cached sentences of text, or None
+        """
+        key = self.key(text)
+
+        row = self.connection.execute("SELECT sentences FROM segments WHERE key = ?", (key,)).fetchone()
+
+        if row is None:
+            count("segmentation cache misses")
+
+            return None
+
+        count("segmentation cache hits")
+
+        self.used.append(key)
+        self._commit_if_needed()
+
+        return json.loads(row[0])
+
+
+    def put(self, text, sentences):
+        """
+        Stores the sentences of text
+        """
+        key = self.key(text)
+        data = json.dumps(sentences)
+
+        self.inserted.append((key, data, len(key) + len(data)))
+        self._commit_if_needed()
+
+
+    def _commit_if_needed(self):
+        if len(self.inserted) + len(self.used) >= COMMIT_INTERVAL:
+            self.commit()
+
+
+    def commit(self):
+        """
+        Writes pending segmentations and access times
+        """
+        now = int(time.time())
+
+        self.connection.executemany("INSERT OR REPLACE INTO segments VALUES (?, ?, ?, ?)",
+            ((key, data, size, now) for key, data, size in self.inserted))
+        self.connection.executemany("UPDATE segments SET used = ? WHERE key = ?", ((now, key) for key in self.used))
+        self.connection.commit()
+
+        del self.inserted[:]
+        del self.used[:]
+
+
+    def evict(self):
+        """
+        Removes the least recently used segmentations until the cache fits in max_size, and returns their number
+        """
+        self.commit()
+
+        total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM segments").fetchone()[0]
+
+        if total <= self.max_size:
+            return 0
+
+        evicted = []
+
+        for key, size in self.connection.execute("SELECT key, size FROM segments ORDER BY used"):
+            if total <= self.max_size:
+                break
+
+            evicted.append((key,))
+            total -= size
+
+        self.connection.executemany("DELETE FROM segments WHERE key = ?", evicted)
+        self.connection.commit()
+
+        return len(evicted)
+
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+
+def tokenizer_version():
+    """
+    Identifies the segmentation output: NLTK version, punkt model and joining rules
+    """
+    from segmentation import PUNKT_MODEL, SEGMENTATION_VERSION
+
+    return "nltk-{0}/{1}/{2}".format(nltk_version(), PUNKT_MODEL, SEGMENTATION_VERSION)
+
+
+def nltk_version():
+    """
+    Reads the NLTK version from its package, without the cost of importing it
+    """
+    version_file = os.path.join(imp.find_module("nltk")[1], "VERSION")
+
+    if not os.path.exists(version_file):
+        import nltk
+
+        return nltk.__version__
+
+    with open(version_file) as f:
+        return f.read().strip()
+
+
+def open_cache(path, max_size=DEFAULT_CACHE_SIZE * 2 ** 20):
+    """
+    Opens the segmentation cache used by segmentation.segment_batch in this process
+    """
+    global cache
+
+    cache = SegmentationCache(path, max_size=max_size)
+
+    # pool workers exit without returning to the caller, so pending rows are written on exit
+    Finalize(cache, cache.commit, exitpriority=10)
+
+    return cache
+
+
+def report_cache(path, max_size=DEFAULT_CACHE_SIZE * 2 ** 20):
+    """
+    Evicts old entries of the cache and prints the hit and miss counts of the run
+    """
+    evicted = (cache or SegmentationCache(path, max_size=max_size)).evict()
+
+    timed_print("Segmentation cache: {0} hits, {1} misses, {2} evicted".format(
+        counters["segmentation cache hits"],
+        counters["segmentation cache misses"],
+        evicted
+    ))
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+:Name:
+    shards.py
+
+:Authors:
+    Soufian Salim (soufi@nsal.im)
+"""
+
+import json
+import os
+import struct
+
+from compression import open_file, compressed_filename
+from metrics import measure
+
+
+DEFAULT_SHARD_SIZE = 64
+
+SHARD_EXTENSION = ".shard"
+
+# a document of a shard is addressed as "folder/label_1.shard#label_12.xml"
+MEMBER_SEPARATOR = "#"
+
+# documents are stored one after the other, followed by their offset table, a JSON list of
+# [name, offset, length], and by this trailer giving the position of the table
+TRAILER = struct.Struct(">Q8s")
+
+MAGIC = b"ODSHARD1"
+
+readers = {}
+
+
+class ShardWriter(object):
+    """
+    Writes named documents to numbered shards of at most max_size bytes (a larger document
+    gets a shard of its own)
+    """
+
+    def __init__(self, output_folder, label, max_size=DEFAULT_SHARD_SIZE * 2 ** 20):
+        self.output_folder = output_folder
+        self.label = label
+        self.max_size = max_size
+        self.number = 0
+        self.shard = None
+        self.table = []
+        self.size = 0
+
+
+    def write(self, name, document):
+        """
+        Appends a document, given as unicode or UTF-8 bytes, to the current shard
+        """
+        if isinstance(document, unicode):
+            document = document.encode("utf-8")
+
+        if self.shard is None or (self.table and self.size + len(document) > self.max_size):
+            self.close()
+            self.open()
+
+        with measure("write", size=len(document)):
+            self.shard.write(document)
+        self.table.append([name, self.size, len(document)])
+        self.size += len(document)
+
+
+    def move(self, filepath, name):
+        """
+        Appends the content of a file as a document, then deletes the file
+        """
+        with open(filepath, "rb") as f:
+            self.write(name, f.read())
+
+        os.remove(filepath)
+
+
+    def open(self):
+        self.number += 1
+        self.shard = open(shard_filename(self.output_folder, self.label, self.number), "wb")
+        self.table = []
+        self.size = 0
+
+
+    def close(self):
+        """
+        Writes the offset table of the current shard and closes it
+        """
+        if self.shard is None:
+            return
+
+        self.shard.write(json.dumps(self.table).encode("utf-8"))
+        self.shard.write(TRAILER.pack(self.size, MAGIC))
+        self.shard.close()
+
+        self.shard = None
+
+
+class ShardReader(object):
+    """
+    Random access to the documents of a shard through its offset table
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+
+        self.file.seek(-TRAILER.size, os.SEEK_END)
+        trailer_offset = self.file.tell()
+
+        table_offset, magic = TRAILER.unpack(self.file.read(TRAILER.size))
+
+        if magic != MAGIC:
+            raise ValueError("Not a shard: {0}".format(path))
+
+        self.file.seek(table_offset)
+
+        self.table = json.loads(self.file.read(trailer_offset - table_offset).decode("utf-8"))
+        self.offsets = dict((name, (offset, length)) for name, offset, length in self.table)
+
+
+    def names(self):
+        return [name for name, offset, length in self.table]
+
+
+    def read(self, name):
+        """
+        Returns the bytes of a document
+        """
+        offset, length = self.offsets[name]
+
+        self.file.seek(offset)
+
+        return self.file.read(length)
+
+
+    def close(self):
+        self.file.close()
+
+
+def shard_filename(output_folder, label, number):
+    """
+    Returns the path of a numbered shard
+    """
+    return "{0}{1}_{2}{3}".format(output_folder, label, number, SHARD_EXTENSION)
+
+
+def open_shard(path):
+    """
+    Returns the reader of a shard, kept open for the next documents read in this process
+    """
+    if path not in readers:
+        readers[path] = ShardReader(path)
+
+    return readers[path]
+
+
+def list_members(path):
+    """
+    Lists the addresses of the documents of a shard
+    """
+    reader = ShardReader(path)
+    names = reader.names()
+    reader.close()
+
+    return [path + MEMBER_SEPARATOR + name for name in names]
+
+
+def split_member(source):
+    """
+    Returns the shard path and document name of a shard member, or (source, None) for a plain file
+    """
+    if MEMBER_SEPARATOR in source:
+        path, name = source.rsplit(MEMBER_SEPARATOR, 1)
+
+        if path.endswith(SHARD_EXTENSION):
+            return path, name
+
+    return source, None
+
+
+def read_source(source):
+    """
+    Returns the content of a plain file, decompressed if needed, or of a shard member, decoded from UTF-8
+    """
+    return read_bytes(source).decode("utf-8")
+
+
+def read_bytes(source):
+    """
+    Returns the bytes of a plain file, decompressed if needed, or of a shard member
+    """
+    path, name = split_member(source)
+
+    with measure("read") as measurement:
+        if name is None:
+            with open_file(path) as f:
+                data = f.read()
+        else:
+            data = open_shard(path).read(name)
+
+        measurement.size = len(data)
+
+    return data
+
+
+def output_path(source, extension, compression=None):
+    """
+    Returns the path of a converted file: next to the source for a plain file, and next to the
+    shard, named after the document, for a shard member
+
+    The output is compressed like a plain source, unless another compression is given.
+    """
+    path, name = split_member(source)
+
+    if name is None:
+        output = source.replace("xml", extension)
+    else:
+        output = os.path.join(os.path.dirname(path), name.replace("xml", extension))
+
+    return compressed_filename(output, compression) if compression else output
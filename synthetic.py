@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+:Name:
+    synthetic.py
+
+:Authors:
+    Soufian Salim (soufi@nsal.im)
+"""
+
+import collections
+import doctest
+import io
+import json
+import os
+import random
+
+from optparse import OptionParser
+from utility import timed_print
+
+
+WORDS = (u"bonjour merci le la les un une problème réseau câble box connexion ça ne marche pas toujours "
+    u"avez-vous essayé de redémarrer depuis hier soir mise à jour écran voyant rouge clignote").split()
+
+
+def make_email_thread(rng, depth, fanout, number=0):
+    """
+    Builds an email with fanout answers per message down to depth levels of replies
+
+    >>> count_messages(make_email_thread(random.Random(0), 2, 3))
+    13
+    """
+    stack = []
+    root = make_email(rng, number)
+
+    stack.append((root, 0))
+
+    # built with a stack, so that deep threads do not reach the recursion limit
+    while stack:
+        email, level = stack.pop()
+
+        if level < depth:
+            email["answers"] = [make_email(rng, number, email) for i in range(fanout)]
+
+            stack.extend((answer, level + 1) for answer in email["answers"])
+
+    return root
+
+
+def make_email(rng, number, parent=None):
+    """
+    Builds one email, answering parent if given
+    """
+    author = rng.randint(0, 49)
+
+    return {
+        "subject": u"Re: " + parent["subject"] if parent else u"Sujet {0} : {1}".format(number, make_sentence(rng)),
+        "datetime": make_datetime(rng),
+        "content": make_body(rng, quote=parent["content"] if parent else None),
+        "author_name": u"Utilisateur {0}".format(author),
+        "author_address": u"utilisateur{0}@example.org".format(author),
+    }
+
+
+def make_forum(rng, number, threads, posts):
+    """
+    Builds a forum of threads having posts posts each, with HTML bodies and some signatures
+
+    >>> forum = make_forum(random.Random(0), 1, 4, 5)
+    >>> len(forum["threads"]), sum(len(thread["posts"]) for thread in forum["threads"])
+    (4, 20)
+    """
+    # the description comes first, so that the threads can be streamed
+    return collections.OrderedDict([
+        ("description", u"Forum {0}".format(number)),
+        ("threads", [{
+            "name": u"Discussion {0}.{1} : {2}".format(number, i, make_sentence(rng)),
+            "closed": rng.random() < 0.3,
+            "posts": [make_post(rng) for j in range(posts)],
+        } for i in range(threads)]),
+    ])
+
+
+def make_post(rng):
+    author = rng.randint(0, 49)
+
+    return {
+        "datetime": make_datetime(rng),
+        "content": make_body(rng, html=True),
+        "signature": u"<i>Membre n°{0}</i>".format(author) if rng.random() < 0.4 else None,
+        "author": u"membre{0}".format(author),
+        "author_id": author,
+    }
+
+
+def make_body(rng, quote=None, html=False):
+    """
+    Builds a message body of several lines, quoting the first line of another body and signed in
+    plain text, or made of HTML paragraphs and breaks
+    """
+    lines = [make_sentence(rng) for i in range(rng.randint(1, 8))]
+
+    if html:
+        return u"".join(u"<p>{0}<br>{1}</p>".format(line, make_sentence(rng)) for line in lines)
+
+    if quote:
+        lines.insert(0, u"> " + quote.split(u"\n", 1)[0])
+
+    return u"\n".join([u"Bonjour,"] + lines + [u"--", u"Cordialement"])
+
+
+def make_sentence(rng):
+    words = [rng.choice(WORDS) for i in range(rng.randint(3, 20))]
+
+    return u" ".join(words).capitalize() + rng.choice([u".", u" ?", u" !"])
+
+
+def make_datetime(rng):
+    return u"2015-{0:02d}-{1:02d} {2:02d}:{3:02d}:00".format(rng.randint(1, 12), rng.randint(1, 28),
+        rng.randint(0, 23), rng.randint(0, 59))
+
+
+def count_messages(email):
+    """
+    Returns the number of messages of an email thread
+    """
+    count = 0
+    stack = [email]
+
+    while stack:
+        email = stack.pop()
+        count += 1
+        stack.extend(email.get("answers", ()))
+
+    return count
+
+
+def write_dataset(output_folder, email_files=2, threads=50, depth=3, fanout=2, forum_files=1, forums=2,
+        forum_threads=50, posts=20, seed=0):
+    """
+    Writes email JSON files to output_folder/email and forum JSON files to output_folder/forum, and
+    returns the number of messages written
+    """
+    rng = random.Random(seed)
+    messages = 0
+
+    for medium in ("email", "forum"):
+        if not os.path.isdir(os.path.join(output_folder, medium)):
+            os.makedirs(os.path.join(output_folder, medium))
+
+    for i in range(email_files):
+        data = [make_email_thread(rng, depth, fanout, j) for j in range(threads)]
+
+        messages += sum(count_messages(email) for email in data)
+
+        save_json(data, os.path.join(output_folder, "email", "list{0}.json".format(i)))
+
+    for i in range(forum_files):
+        data = [make_forum(rng, i * forums + j, forum_threads, posts) for j in range(forums)]
+
+        messages += forums * forum_threads * posts
+
+        save_json(data, os.path.join(output_folder, "forum", "forum{0}.json".format(i)))
+
+    return messages
+
+
+def save_json(data, filepath):
+    with io.open(filepath, "w", encoding="utf-8") as f:
+        f.write(json.dumps(data, ensure_ascii=False, indent=1))
+
+
+def synthetic(opts, args):
+    """
+    Generates synthetic email and forum JSON data
+    """
+    output_folder = args[0]
+
+    messages = write_dataset(output_folder, opts.email_files, opts.threads, opts.depth, opts.fanout,
+        opts.forum_files, opts.forums, opts.forum_threads, opts.posts, opts.seed)
+
+    timed_print("Wrote {0} messages to {1}".format(messages, output_folder))
+
+
+def parse_args():
+    """
+     Parse command line opts and arguments
+    """
+
+    op = OptionParser(usage="usage: %prog [opts] output_folder")
+
+    op.add_option("--test",
+        dest="test",
+        default=False,
+        action="store_true",
+        help="executes the test suite")
+
+    op.add_option("--email-files",
+        dest="email_files",
+        default=2,
+        type="int",
+        help="number of email files, each of them being a category (default: 2)")
+
+    op.add_option("--threads",
+        dest="threads",
+        default=50,
+        type="int",
+        help="number of threads of an email file (default: 50)")
+
+    op.add_option("--depth",
+        dest="depth",
+        default=3,
+        type="int",
+        help="number of levels of replies of an email thread (default: 3)")
+
+    op.add_option("--fanout",
+        dest="fanout",
+        default=2,
+        type="int",
+        help="number of replies to each email (default: 2)")
+
+    op.add_option("--forum-files",
+        dest="forum_files",
+        default=1,
+        type="int",
+        help="number of forum files (default: 1)")
+
+    op.add_option("--forums",
+        dest="forums",
+        default=2,
+        type="int",
+        help="number of forums of a forum file (default: 2)")
+
+    op.add_option("--forum-threads",
+        dest="forum_threads",
+        default=50,
+        type="int",
+        help="number of threads of a forum (default: 50)")
+
+    op.add_option("--posts",
+        dest="posts",
+        default=20,
+        type="int",
+        help="number of posts of a forum thread (default: 20)")
+
+    op.add_option("--seed",
+        dest="seed",
+        default=0,
+        type="int",
+        help="seed of the random generator (default: 0)")
+
+    return op.parse_args()
+
+
+if __name__ == "__main__":
+    options, arguments = parse_args()
+
+    if options.test:
+        doctest.testmod() # unit testing
+    else:
+        if not arguments[0].endswith("/"):
+            arguments[0] = arguments[0] + "/"
+
+        synthetic(options, arguments)
@@ -9,8 +9,28 @@
     Soufian Salim (soufi@nsal.im)
 """
 
-import io
+import cProfile
+import hashlib
+import json
+import os
+import resource
+import sys
 import time
+import traceback
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None # python 3.4+, or pytracemalloc on a patched python 2
+
+from itertools import imap
+from multiprocessing import Pool
+from progressbar import ProgressBar, UnknownLength, Counter, AnimatedMarker, Timer
+from compression import DEFAULT_LEVEL, open_file, compressed_filename
+from shards import SHARD_EXTENSION, list_members
+from metrics import counters, measure, cpu_time, report
+
+show_progress = True
 
 
 def timed_print(message):
@@ -20,6 +40,149 @@ def timed_print(message):
     print("[{0}] {1}".format(time.strftime("%H:%M:%S"), message))
 
 
+def progress_bar(iterable, maxval=None):
+    """
+    Wraps an iterable in a progress bar, counting items when its length is unknown
+    """
+    if not show_progress:
+        return iterable
+
+    if maxval is None and hasattr(iterable, "__len__"):
+        maxval = len(iterable)
+
+    # progressbar fails on empty iterables
+    if maxval == 0:
+        return iterable
+
+    if maxval is not None:
+        return ProgressBar(maxval=maxval)(iterable)
+
+    widgets = [Counter(), " ", AnimatedMarker(), " ", Timer()]
+
+    return ProgressBar(widgets=widgets, maxval=UnknownLength)(iterable).start()
+
+
+def count(name, value=1):
+    """
+    Adds to a named counter of the current run, gathered from worker processes by convert_files
+    """
+    counters[name] += value
+
+
+def list_xml_files(input_folder):
+    """
+    Lists the XML files, compressed or not, found under a folder, and the XML documents of the
+    shards found there
+    """
+    xml_files = []
+
+    for dirpath, dirnames, filenames in os.walk(input_folder):
+        for filename in filenames:
+            if compressed_filename(filename).endswith(".xml"):
+                xml_files.append(os.path.join(dirpath, filename))
+            elif filename.endswith(SHARD_EXTENSION):
+                xml_files.extend(list_members(os.path.join(dirpath, filename)))
+
+    return xml_files
+
+
+def convert_files(convert, filenames, jobs=1, initializer=None, initargs=()):
+    """
+    Applies convert to every file, in order, using jobs worker processes, and returns the
+    (filename, error) pairs of the files that could not be converted
+    """
+    if jobs > 1:
+        pool = Pool(jobs, initializer=initializer, initargs=initargs)
+        results = pool.imap(IsolatedCall(convert), filenames, chunksize=4)
+    else:
+        if initializer:
+            initializer(*initargs)
+
+        pool = None
+        results = imap(IsolatedCall(convert), filenames)
+
+    failures = []
+
+    for filename, error, run_counters in progress_bar(results, maxval=len(filenames)):
+        counters.update(run_counters)
+
+        if error:
+            failures.append((filename, error))
+
+    if pool:
+        pool.close()
+        pool.join()
+
+    for filename, error in failures:
+        timed_print("Could not convert {0}:\n{1}".format(filename, error))
+
+    return failures
+
+
+class IsolatedCall(object):
+    """
+    Picklable wrapper returning (argument, formatted traceback or None, counters) instead of raising
+    """
+
+    def __init__(self, function):
+        self.function = function
+
+
+    def __call__(self, argument):
+        error = None
+
+        try:
+            self.function(argument)
+        except Exception:
+            error = traceback.format_exc()
+
+        run_counters = dict(counters)
+        counters.clear()
+
+        return argument, error, run_counters
+
+
+def disable_progress():
+    """
+    Turns off progress bars, e.g. in worker processes sharing the parent's terminal
+    """
+    global show_progress
+
+    show_progress = False
+
+
+def peak_memory():
+    """
+    Returns the peak resident set size of the current process, in bytes
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def file_hash(filepath, chunk_size=2 ** 20):
+    """
+    Returns the SHA-1 hex digest of a file's content
+    """
+    digest = hashlib.sha1()
+
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def to_int(value):
+    """
+    Converts a number that may have been loaded as text, or be missing, to an integer
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
 def remove_extension(filename):
 	"""
 	Returns a filename without the extension
@@ -30,9 +193,71 @@ def remove_extension(filename):
 		return filename
 
 
-def save_to_file(string, filepath):
+def save_tree(tree, filepath, level=DEFAULT_LEVEL):
     """
-    Saves string to file
+    Writes an ElementTree to file, compressed at the given level if the file name ends with .gz, .bz2 or .xz
     """
-    with io.open(filepath, "w", encoding="utf-8") as f:
-        f.write(unicode(string))
\ No newline at end of file
+    with measure("write") as measurement, open_file(filepath, "wb", level) as f:
+        tree.write(f)
+
+        measurement.size = f.tell()
+
+
+def save_to_file(string, filepath, level=DEFAULT_LEVEL):
+    """
+    Saves string to file, compressed at the given level if the file name ends with .gz, .bz2 or .xz
+    """
+    data = unicode(string).encode("utf-8")
+
+    with measure("write", size=len(data)), open_file(filepath, "wb", level) as f:
+        f.write(data)
+
+
+def run_script(main, opts, args):
+    """
+    Runs the main function of a script, profiling it with --profile and writing the metrics of the
+    run with --metrics-json, and returns what the main function returned
+    """
+    wall, cpu = time.time(), cpu_time()
+
+    if opts.profile:
+        result = profile(main, opts, args, opts.profile)
+    else:
+        result = main(opts, args)
+
+    if opts.metrics_json:
+        metrics = report(time.time() - wall, cpu_time() - cpu, peak_memory())
+
+        with open(opts.metrics_json, "w") as f:
+            json.dump(metrics, f, indent=2, sort_keys=True)
+
+        timed_print("Metrics written to {0}".format(opts.metrics_json))
+
+    return result
+
+
+def profile(main, opts, args, prefix):
+    """
+    Runs the main function of a script under cProfile, writing its statistics to prefix.prof and,
+    when tracemalloc is available, a snapshot of the allocations still alive at the end of the run to
+    prefix.tracemalloc
+
+    Only the current process is profiled, not the worker processes.
+    """
+    if tracemalloc:
+        tracemalloc.start()
+
+    profiler = cProfile.Profile()
+
+    try:
+        return profiler.runcall(main, opts, args)
+    finally:
+        profiler.dump_stats(prefix + ".prof")
+
+        if tracemalloc:
+            tracemalloc.take_snapshot().dump(prefix + ".tracemalloc")
+            tracemalloc.stop()
+        else:
+            timed_print("tracemalloc is not available, no memory snapshot was written")
+
+        timed_print("Profile written to {0}.prof".format(prefix))
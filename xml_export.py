@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+:Name:
+    xml_export.py
+
+:Authors:
+    Soufian Salim (soufi@nsal.im)
+"""
+
+import doctest
+
+from optparse import OptionParser
+from conversations import Conversation
+from metrics import measure
+from utility import timed_print, run_script, save_to_file, save_tree, list_xml_files, convert_files
+from xml_to_tsv import convert_to_tsv
+from segmentation import init_worker, segment_messages
+from segmentation_cache import DEFAULT_CACHE_SIZE, report_cache, tokenizer_version
+from compression import COMPRESSIONS, DEFAULT_LEVEL
+from shards import read_source, output_path
+from build_record import CHECKS, BuildRecord, record_path, convert_stale
+from xml_index import plan_files
+from xml_to_txt import convert_to_txt
+from xml_to_html import build_html_tree
+
+
+FORMATS = ["tsv", "txt", "html"]
+
+
+def xml_export(opts, args):
+    """
+    Converts messages from the ODISAE format to several formats in a single pass
+    """
+    input_folder = args[0]
+
+    formats = opts.formats.split(",")
+
+    for output_format in formats:
+        if output_format not in FORMATS:
+            raise ValueError("Unknown format: {0}".format(output_format))
+
+    xml_files = list_xml_files(input_folder)
+
+    if opts.index or opts.category is not None:
+        xml_files = plan_files(input_folder, xml_files, opts.category, jobs=opts.jobs)
+
+    timed_print("Exporting {0} xml files from {1} to {2}...".format(len(xml_files), input_folder, ", ".join(formats)))
+
+    run = lambda filenames: convert_files(FileExporter(formats, opts.pos_tags, opts.compress, opts.compression_level), filenames, jobs=opts.jobs,
+        initializer=init_worker, initargs=(opts.cache, opts.cache_size))
+
+    if opts.incremental:
+        settings = {"formats": sorted(formats), "pos_tags": opts.pos_tags, "segmentation": tokenizer_version()}
+        record = BuildRecord(record_path(input_folder, "xml_export"), settings, check=opts.check)
+
+        convert_stale(record, xml_files, lambda xml_file: [output_path(xml_file, f, opts.compress) for f in formats], run)
+    else:
+        run(xml_files)
+
+    if opts.cache:
+        report_cache(opts.cache, opts.cache_size * 2 ** 20)
+
+    timed_print("Done")
+
+
+class FileExporter(object):
+    """
+    Parses an XML file and segments its messages once, then writes every requested format
+    """
+
+    def __init__(self, formats, pos_tags=False, compression=None, level=DEFAULT_LEVEL):
+        self.formats = formats
+        self.pos_tags = pos_tags
+        self.compression = compression
+        self.level = level
+
+
+    def __call__(self, xml_file):
+        xml = read_source(xml_file)
+
+        with measure("model_build"):
+            conversation = Conversation(xml)
+
+        segments = segment_messages(conversation)
+
+        if "tsv" in self.formats:
+            with measure("serialize"):
+                tsv = convert_to_tsv(conversation, segments, pos_tags=self.pos_tags)
+
+            save_to_file(tsv, output_path(xml_file, "tsv", self.compression), self.level)
+
+        if "txt" in self.formats:
+            with measure("serialize"):
+                txt = convert_to_txt(conversation, segments)
+
+            save_to_file(txt, output_path(xml_file, "txt", self.compression), self.level)
+
+        if "html" in self.formats:
+            with measure("serialize"):
+                tree = build_html_tree(conversation, segments)
+
+            save_tree(tree, output_path(xml_file, "html", self.compression), self.level)
+
+
+def parse_args():
+    """
+     Parse command line opts and arguments 
+    """
+
+    op = OptionParser(usage="usage: %prog [opts] input_folder")
+
+    op.add_option("--test",
+        dest="test",
+        default=False,
+        action="store_true",
+        help="executes the test suite")
+
+    op.add_option("--formats",
+        dest="formats",
+        default=",".join(FORMATS),
+        type="string",
+        help="comma-separated output formats among tsv, txt and html (default: all)")
+
+    op.add_option("--pos-tags",
+        dest="pos_tags",
+        default=False,
+        action="store_true",
+        help="writes the part-of-speech tag of each token in a third column of the TSV")
+
+    op.add_option("--jobs",
+        dest="jobs",
+        default=1,
+        type="int",
+        help="number of worker processes converting files in parallel (default: 1)")
+
+    op.add_option("--compress",
+        dest="compress",
+        default=None,
+        type="choice",
+        choices=COMPRESSIONS,
+        help="compresses the outputs: gz, bz2 or xz (default: like the source)")
+
+    op.add_option("--compression-level",
+        dest="compression_level",
+        default=DEFAULT_LEVEL,
+        type="int",
+        help="compression level, from 1 (fastest) to 9 (smallest) (default: {0})".format(DEFAULT_LEVEL))
+
+    op.add_option("--incremental",
+        dest="incremental",
+        default=False,
+        action="store_true",
+        help="only converts the files changed since the last incremental run, or whose outputs are missing")
+
+    op.add_option("--check",
+        dest="check",
+        default="mtime",
+        type="choice",
+        choices=CHECKS,
+        help="how changed files are detected in incremental mode: mtime or hash (default: mtime)")
+
+    op.add_option("--index",
+        dest="index",
+        default=False,
+        action="store_true",
+        help="updates the index of the input folder and converts the largest conversations first")
+
+    op.add_option("--category",
+        dest="category",
+        default=None,
+        type="string",
+        help="only converts the conversations of this category, found through the index")
+
+    op.add_option("--cache",
+        dest="cache",
+        default=None,
+        type="string",
+        help="SQLite file caching sentence segmentations across runs")
+
+    op.add_option("--cache-size",
+        dest="cache_size",
+        default=DEFAULT_CACHE_SIZE,
+        type="int",
+        help="maximum size of the segmentation cache in MB (default: {0})".format(DEFAULT_CACHE_SIZE))
+
+    op.add_option("--metrics-json",
+        dest="metrics_json",
+        default=None,
+        type="string",
+        help="writes the wall and CPU time, items and bytes of each stage of the run to this JSON file")
+
+    op.add_option("--profile",
+        dest="profile",
+        default=None,
+        type="string",
+        help="profiles the run with cProfile to PROFILE.prof, and with tracemalloc to PROFILE.tracemalloc when available")
+
+    return op.parse_args()
+
+
+if __name__ == "__main__":
+    options, arguments = parse_args()
+
+    if not arguments[0].endswith("/"):
+        arguments[0] = arguments[0] + "/"
+
+    if options.test:
+        doctest.testmod() # unit testing
+    else:
+        run_script(xml_export, options, arguments)
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+:Name:
+    xml_index.py
+
+:Authors:
+    Soufian Salim (soufi@nsal.im)
+"""
+
+import doctest
+import json
+import os
+
+from itertools import imap
+from multiprocessing import Pool
+from optparse import OptionParser
+from conversations import Conversation
+from shards import read_source, split_member
+from utility import timed_print, list_xml_files, progress_bar
+
+
+INDEX_FILENAME = ".index.jsonl"
+
+
+def xml_index(opts, args):
+    """
+    Indexes the XML files of a folder, then lists those matching the query options, largest first
+    """
+    input_folder = args[0]
+
+    xml_files = list_xml_files(input_folder)
+
+    timed_print("Indexing {0} xml files from {1}...".format(len(xml_files), input_folder))
+
+    entries, indexed = build_index(input_folder, xml_files, jobs=opts.jobs)
+
+    timed_print("Indexed {0} files, {1} unchanged".format(indexed, len(entries) - indexed))
+
+    if opts.category is not None or opts.participant is not None or opts.min_messages:
+        selected = select(entries, opts.category, opts.participant, opts.min_messages)
+
+        for key in selected:
+            print(os.path.join(input_folder, key))
+
+        timed_print("Selected {0} of {1} files".format(len(selected), len(entries)))
+
+
+def build_index(input_folder, xml_files, jobs=1):
+    """
+    Writes the index of a folder, only reading the files changed since the last index, and
+    returns the entries of the given files, by path relative to the folder, and the number of
+    files read
+    """
+    previous = load_index(input_folder)
+
+    entries = {}
+    stale = []
+
+    for xml_file in xml_files:
+        key = os.path.relpath(xml_file, input_folder)
+        state = file_state(xml_file)
+
+        if key in previous and previous[key]["state"] == state:
+            entries[key] = previous[key]
+        else:
+            stale.append(xml_file)
+
+    if jobs > 1:
+        pool = Pool(jobs)
+        results = pool.imap(index_entry, stale, chunksize=16)
+    else:
+        pool = None
+        results = imap(index_entry, stale)
+
+    for xml_file, entry in zip(stale, progress_bar(results, maxval=len(stale))):
+        entries[os.path.relpath(xml_file, input_folder)] = entry
+
+    if pool:
+        pool.close()
+        pool.join()
+
+    path = index_path(input_folder)
+
+    with open(path + ".part", "w") as f:
+        for key in sorted(entries):
+            entry = dict(entries[key], file=key)
+
+            f.write(json.dumps(entry, sort_keys=True, separators=(",", ":")) + "\n")
+
+    os.rename(path + ".part", path)
+
+    return entries, len(stale)
+
+
+def index_entry(xml_file):
+    """
+    Reads an XML file and returns its index entry
+    """
+    state = file_state(xml_file)
+    xml = read_source(xml_file)
+    conversation = Conversation(xml)
+
+    participants = set()
+
+    for message in conversation.messages:
+        participants.update(unicode(participant.id) for participant in message.participant_from)
+        participants.update(unicode(participant.id) for participant in message.participant_to)
+
+    return {
+        "id": unicode(conversation.id) if conversation.id is not None else None,
+        "subject": conversation.subject,
+        "category": conversation.category,
+        "messages": len(conversation.messages),
+        "participants": sorted(participants),
+        "size": len(xml.encode("utf-8")),
+        "state": state,
+    }
+
+
+def file_state(source):
+    """
+    Returns the modification time and size of a file, or of the shard holding a document
+    """
+    stat = os.stat(split_member(source)[0])
+
+    return [stat.st_mtime, stat.st_size]
+
+
+def index_path(input_folder):
+    return os.path.join(input_folder, INDEX_FILENAME)
+
+
+def load_index(input_folder):
+    """
+    Returns the entries of the index of a folder, by path relative to the folder, or an empty dictionary
+    """
+    entries = {}
+
+    if os.path.exists(index_path(input_folder)):
+        with open(index_path(input_folder)) as f:
+            for line in f:
+                entry = json.loads(line)
+                entries[entry.pop("file")] = entry
+
+    return entries
+
+
+def select(entries, category=None, participant=None, min_messages=0):
+    """
+    Returns the keys of the entries of a category, involving a participant or having at least
+    min_messages messages, largest first
+    """
+    selected = []
+
+    for key, entry in entries.items():
+        if category is not None and entry["category"] != category:
+            continue
+
+        if participant is not None and participant not in entry["participants"]:
+            continue
+
+        if entry["messages"] < min_messages:
+            continue
+
+        selected.append(key)
+
+    return sorted(selected, key=lambda key: (-entries[key]["size"], key))
+
+
+def plan_files(input_folder, xml_files, category=None, jobs=1):
+    """
+    Updates the index of a folder and returns the given files of a category, largest first, so
+    that workers converting them in parallel finish together
+    """
+    entries, indexed = build_index(input_folder, xml_files, jobs=jobs)
+
+    timed_print("Indexed {0} files, {1} unchanged".format(indexed, len(entries) - indexed))
+
+    return [os.path.join(input_folder, key) for key in select(entries, category)]
+
+
+def parse_args():
+    """
+     Parse command line opts and arguments
+    """
+
+    op = OptionParser(usage="usage: %prog [opts] input_folder")
+
+    op.add_option("--test",
+        dest="test",
+        default=False,
+        action="store_true",
+        help="executes the test suite")
+
+    op.add_option("--jobs",
+        dest="jobs",
+        default=1,
+        type="int",
+        help="number of worker processes reading files in parallel (default: 1)")
+
+    op.add_option("--category",
+        dest="category",
+        default=None,
+        type="string",
+        help="lists the files of conversations of this category")
+
+    op.add_option("--participant",
+        dest="participant",
+        default=None,
+        type="string",
+        help="lists the files of conversations involving this participant id")
+
+    op.add_option("--min-messages",
+        dest="min_messages",
+        default=0,
+        type="int",
+        help="lists the files of conversations having at least this many messages")
+
+    return op.parse_args()
+
+
+if __name__ == "__main__":
+    options, arguments = parse_args()
+
+    if not arguments[0].endswith("/"):
+        arguments[0] = arguments[0] + "/"
+
+    if options.test:
+        doctest.testmod() # unit testing
+    else:
+        xml_index(options, arguments)
@@ -9,22 +9,19 @@
     Soufian Salim (soufi@nsal.im)
 """
 
-import codecs
 import doctest
-import os
-import nltk.data
+import functools
 
-from nltk import pos_tag
-from nltk.stem.wordnet import WordNetLemmatizer
-from nltk.tokenize import word_tokenize
-from progressbar import ProgressBar
 from optparse import OptionParser
 from conversations import Conversation
-from utility import timed_print, save_to_file
-
-tokenizer = nltk.data.load("tokenizers/punkt/french.pickle")
-
-progress = ProgressBar()
+from segmentation import init_worker, segment_messages
+from segmentation_cache import DEFAULT_CACHE_SIZE, report_cache, tokenizer_version
+from compression import COMPRESSIONS, DEFAULT_LEVEL
+from shards import read_source, output_path
+from build_record import CHECKS, BuildRecord, record_path, convert_stale
+from xml_index import plan_files
+from metrics import measure
+from utility import timed_print, run_script, save_to_file, list_xml_files, convert_files
 
 
 def xml_to_tsv(opts, args):
@@ -33,89 +30,87 @@ def xml_to_tsv(opts, args):
     """
     input_folder = args[0]
 
-    xml_files = []
+    xml_files = list_xml_files(input_folder)
 
-    for dirpath, dirnames, filenames in os.walk(input_folder):
-        for filename in filenames:
-            if filename.endswith(".xml"):
-                xml_files.append(os.path.join(dirpath, filename))
+    if opts.index or opts.category is not None:
+        xml_files = plan_files(input_folder, xml_files, opts.category, jobs=opts.jobs)
 
     timed_print("Converting {0} xml files from {1}...".format(len(xml_files), input_folder))
 
-    for xml_file in progress(xml_files):
-        xml = codecs.open(xml_file, encoding="utf-8").read()
-        conversation = Conversation(xml)
-
-        tsv = convert_to_tsv(conversation)
-
-        save_to_file(tsv, xml_file.replace("xml", "tsv"))
+    convert = functools.partial(convert_file, pos_tags=opts.pos_tags, compression=opts.compress,
+        level=opts.compression_level)
 
-    timed_print("Done")
+    run = lambda filenames: convert_files(convert, filenames, jobs=opts.jobs, initializer=init_worker,
+        initargs=(opts.cache, opts.cache_size))
 
+    if opts.incremental:
+        record = BuildRecord(record_path(input_folder, "xml_to_tsv"), {"pos_tags": opts.pos_tags, "segmentation": tokenizer_version()}, check=opts.check)
 
-def convert_to_tsv(conversation):
-    lines = []
+        convert_stale(record, xml_files, lambda xml_file: [output_path(xml_file, "tsv", opts.compress)], run)
+    else:
+        run(xml_files)
 
-    for n, message in enumerate(conversation.messages):
-        lines.append(u"1-1\t<<<<<")
-        lines.append("")
-        lines.append(u"1-1\tMessage n°{0} from {1}".format(n + 1, message.participant_from[0].email))
-        lines.append("")
-        lines.append(u"1-1\t>>>>>")
-        lines.append("")
+    if opts.cache:
+        report_cache(opts.cache, opts.cache_size * 2 ** 20)
 
-        for i, sentence in enumerate(generate_sentences(message.body)):
-            for j, (token, pos) in enumerate(pos_tag(word_tokenize(sentence))):
+    timed_print("Done")
 
-                lines.append(u"{0}-{1}\t{2}".format(
-                    i + 1,
-                    j + 1,
-                    token
-                ))
 
-            lines.append("")
+def convert_file(xml_file, pos_tags=False, compression=None, level=DEFAULT_LEVEL):
+    """
+    Converts a single XML file, writing the result next to it
+    """
+    xml = read_source(xml_file)
 
-    return "\n".join(lines)
+    with measure("model_build"):
+        conversation = Conversation(xml)
 
+    with measure("serialize"):
+        tsv = convert_to_tsv(conversation, pos_tags=pos_tags)
 
-def generate_sentences(text):
-    lines = text.split("\n")
-    lines = [l.strip() for l in lines if not l.strip().startswith(">") and len(l.strip()) > 0]
+    save_to_file(tsv, output_path(xml_file, "tsv", compression), level)
 
-    true_lines = []
 
-    for line in lines:
-        if line.startswith("--"):
-            break
+def convert_to_tsv(conversation, segments=None, pos_tags=False):
+    """
+    Builds the TSV of a conversation, using the sentences of each message from segments if given
 
-        if line.startswith(">") or not len(line) > 0:
-            continue
+    With pos_tags, the part-of-speech tags of all sentences are computed in one batch and
+    written as a third column.
+    """
+    from nltk import word_tokenize # slow to import, only needed when converting
 
-        line = line.replace("<br>", "<br>\n")
-        line = line.replace("</p>", "</p>\n")
+    if segments is None:
+        segments = segment_messages(conversation)
 
-        if len(line) < 65 and len(line) > 0:
-            line += "\n"
-        else:
-            line += " "
+    tokens = [[word_tokenize(sentence) for sentence in sentences] for sentences in segments]
 
-        true_lines.append(line)
+    if pos_tags:
+        from nltk.tag import pos_tag_sents
 
-    true_lines = "".join(true_lines).split("\n")
+        tags = iter(pos_tag_sents([sentence for sentences in tokens for sentence in sentences]))
 
-    sentences = []
+    lines = []
 
-    for line in true_lines:
-        if len(line.strip()) == 0:
-            continue
+    for n, message in enumerate(conversation.messages):
+        lines.append(u"1-1\t<<<<<")
+        lines.append("")
+        lines.append(u"1-1\tMessage n°{0} from {1}".format(n + 1, message.participant_from[0].email))
+        lines.append("")
+        lines.append(u"1-1\t>>>>>")
+        lines.append("")
 
-        tokens = tokenizer.tokenize(line)
+        for i, sentence in enumerate(tokens[n]):
+            if pos_tags:
+                for j, (token, pos) in enumerate(next(tags)):
+                    lines.append(u"{0}-{1}\t{2}\t{3}".format(i + 1, j + 1, token, pos))
+            else:
+                for j, token in enumerate(sentence):
+                    lines.append(u"{0}-{1}\t{2}".format(i + 1, j + 1, token))
 
-        for token in tokens:
-            sentences.append(token)
+            lines.append("")
 
-    for sentence in sentences:
-        yield sentence
+    return "\n".join(lines)
 
 
 def parse_args():
@@ -131,6 +126,80 @@ def parse_args():
         action="store_true",
         help="executes the test suite")
 
+    op.add_option("--jobs",
+        dest="jobs",
+        default=1,
+        type="int",
+        help="number of worker processes converting files in parallel (default: 1)")
+
+    op.add_option("--pos-tags",
+        dest="pos_tags",
+        default=False,
+        action="store_true",
+        help="writes the part-of-speech tag of each token in a third column")
+
+    op.add_option("--compress",
+        dest="compress",
+        default=None,
+        type="choice",
+        choices=COMPRESSIONS,
+        help="compresses the outputs: gz, bz2 or xz (default: like the source)")
+
+    op.add_option("--compression-level",
+        dest="compression_level",
+        default=DEFAULT_LEVEL,
+        type="int",
+        help="compression level, from 1 (fastest) to 9 (smallest) (default: {0})".format(DEFAULT_LEVEL))
+
+    op.add_option("--incremental",
+        dest="incremental",
+        default=False,
+        action="store_true",
+        help="only converts the files changed since the last incremental run, or whose outputs are missing")
+
+    op.add_option("--check",
+        dest="check",
+        default="mtime",
+        type="choice",
+        choices=CHECKS,
+        help="how changed files are detected in incremental mode: mtime or hash (default: mtime)")
+
+    op.add_option("--index",
+        dest="index",
+        default=False,
+        action="store_true",
+        help="updates the index of the input folder and converts the largest conversations first")
+
+    op.add_option("--category",
+        dest="category",
+        default=None,
+        type="string",
+        help="only converts the conversations of this category, found through the index")
+
+    op.add_option("--cache",
+        dest="cache",
+        default=None,
+        type="string",
+        help="SQLite file caching sentence segmentations across runs")
+
+    op.add_option("--cache-size",
+        dest="cache_size",
+        default=DEFAULT_CACHE_SIZE,
+        type="int",
+        help="maximum size of the segmentation cache in MB (default: {0})".format(DEFAULT_CACHE_SIZE))
+
+    op.add_option("--metrics-json",
+        dest="metrics_json",
+        default=None,
+        type="string",
+        help="writes the wall and CPU time, items and bytes of each stage of the run to this JSON file")
+
+    op.add_option("--profile",
+        dest="profile",
+        default=None,
+        type="string",
+        help="profiles the run with cProfile to PROFILE.prof, and with tracemalloc to PROFILE.tracemalloc when available")
+
     return op.parse_args()
 
 
@@ -143,4 +212,4 @@ if __name__ == "__main__":
     if options.test:
         doctest.testmod() # unit testing
     else:
-        xml_to_tsv(options, arguments)
\ No newline at end of file
+        run_script(xml_to_tsv, options, arguments)
\ No newline at end of file
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+:Name:
+    xml_validate.py
+
+:Authors:
+    Soufian Salim (soufi@nsal.im)
+"""
+
+import doctest
+import os
+import sys
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None # only needed to validate
+
+from itertools import imap
+from multiprocessing import Pool
+from optparse import OptionParser
+from metrics import counters, measure
+from shards import read_bytes
+from utility import timed_print, run_script, list_xml_files, progress_bar
+
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "conversation.xsd")
+
+# errors reported for each invalid document, the others being counted
+MAX_ERRORS = 10
+
+schema = None
+
+parser = None
+
+
+def xml_validate(opts, args):
+    """
+    Validates the XML files of a folder against the conversation schema, reporting only the
+    invalid ones, and returns their number
+    """
+    input_folder = args[0]
+
+    xml_files = list_xml_files(input_folder)
+
+    timed_print("Validating {0} xml files from {1}...".format(len(xml_files), input_folder))
+
+    failures = validate_files(xml_files, jobs=opts.jobs)
+
+    for xml_file, errors in failures:
+        report_failure(xml_file, errors, opts.max_errors)
+
+    timed_print("Validated {0} files, {1} invalid".format(len(xml_files), len(failures)))
+
+    return len(failures)
+
+
+def load_schema():
+    """
+    Returns the conversation schema (which includes the message schema), compiled on first use
+
+    Compiling it before starting worker processes lets them share it instead of compiling it again.
+    """
+    global schema, parser
+
+    if schema is None:
+        if etree is None:
+            raise ImportError("Validating XML documents requires the lxml module")
+
+        schema = etree.XMLSchema(etree.parse(SCHEMA_PATH))
+        parser = etree.XMLParser(huge_tree=True) # message bodies can exceed the 10 MB text limit
+
+    return schema
+
+
+def validate_document(xml):
+    """
+    Returns the errors of an XML document given as bytes, or an empty list if it is valid
+    """
+    schema = load_schema()
+
+    with measure("validate", size=len(xml)):
+        try:
+            document = etree.fromstring(xml, parser)
+        except etree.XMLSyntaxError as e:
+            return [format_error(error) for error in parser.error_log] or [unicode(e)]
+
+        if schema.validate(document):
+            return []
+
+        return [format_error(error) for error in schema.error_log]
+
+
+def format_error(error):
+    return u"line {0}: {1}".format(error.line, error.message)
+
+
+def validate_file(source):
+    """
+    Validates a plain file, decompressed if needed, or a shard member, and returns the source, its
+    errors and the counters of the call
+    """
+    try:
+        errors = validate_document(read_bytes(source))
+    except (IOError, ValueError) as e:
+        errors = [u"could not be read: {0}".format(e)]
+
+    run_counters = dict(counters)
+    counters.clear()
+
+    return source, errors, run_counters
+
+
+def validate_files(xml_files, jobs=1):
+    """
+    Validates files in order using jobs worker processes, and returns the (filename, errors) pairs
+    of the invalid ones
+    """
+    load_schema()
+
+    if jobs > 1:
+        pool = Pool(jobs)
+        results = pool.imap(validate_file, xml_files, chunksize=64)
+    else:
+        pool = None
+        results = imap(validate_file, xml_files)
+
+    failures = []
+
+    for xml_file, errors, run_counters in progress_bar(results, maxval=len(xml_files)):
+        counters.update(run_counters)
+
+        if errors:
+            failures.append((xml_file, errors))
+
+    if pool:
+        pool.close()
+        pool.join()
+
+    return failures
+
+
+def check_document(name, xml, max_errors=MAX_ERRORS):
+    """
+    Validates a document right after it is serialized, reporting it and counting it in the
+    invalid_documents counter if it does not match the schema, and tells whether it is valid
+    """
+    errors = validate_document(xml)
+
+    if errors:
+        counters["invalid_documents"] += 1
+
+        report_failure(name, errors, max_errors)
+
+    return not errors
+
+
+def report_failure(name, errors, max_errors=MAX_ERRORS):
+    """
+    Prints the first max_errors errors of an invalid document
+
+    >>> report_failure("x_1.xml", [u"line 3: a", u"line 5: b", u"line 8: c"], max_errors=2) # doctest: +ELLIPSIS
+    [...] x_1.xml is invalid:
+      line 3: a
+      line 5: b
+      and 1 more errors
+    """
+    lines = [u"  " + error for error in errors[:max_errors]]
+
+    if len(errors) > max_errors:
+        lines.append(u"  and {0} more errors".format(len(errors) - max_errors))
+
+    timed_print(u"\n".join([u"{0} is invalid:".format(name)] + lines).encode("utf-8"))
+
+
+def parse_args():
+    """
+     Parse command line opts and arguments
+    """
+
+    op = OptionParser(usage="usage: %prog [opts] input_folder")
+
+    op.add_option("--test",
+        dest="test",
+        default=False,
+        action="store_true",
+        help="executes the test suite")
+
+    op.add_option("--jobs",
+        dest="jobs",
+        default=1,
+        type="int",
+        help="number of worker processes validating files in parallel (default: 1)")
+
+    op.add_option("--max-errors",
+        dest="max_errors",
+        default=MAX_ERRORS,
+        type="int",
+        help="number of errors reported for each invalid file (default: {0})".format(MAX_ERRORS))
+
+    op.add_option("--metrics-json",
+        dest="metrics_json",
+        default=None,
+        type="string",
+        help="writes the wall and CPU time, items and bytes of each stage of the run to this JSON file")
+
+    op.add_option("--profile",
+        dest="profile",
+        default=None,
+        type="string",
+        help="profiles the run with cProfile to PROFILE.prof, and with tracemalloc to PROFILE.tracemalloc when available")
+
+    return op.parse_args()
+
+
+if __name__ == "__main__":
+    options, arguments = parse_args()
+
+    if options.test:
+        doctest.testmod() # unit testing
+    else:
+        if not arguments[0].endswith("/"):
+            arguments[0] = arguments[0] + "/"
+
+        if run_script(xml_validate, options, arguments):
+            sys.exit(1) # for builds to fail on invalid files